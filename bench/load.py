@@ -0,0 +1,200 @@
+"""Нагрузочный прогон бота целиком, без сети.
+
+Поднимает заглушку (bench/stub.py) вместо YandexGPT/SpeechKit/Bot API, собирает настоящий
+Dispatcher через register_handlers и гоняет через него синтетические сессии:
+продукты -> стиль -> категория -> блюдо. В конце печатает пропускную способность,
+p50/p95/p99 по шагам и рост памяти по раундам.
+
+    python -m bench.load --users 200 --concurrency 50 --rounds 3 --latency 0.3
+"""
+import argparse
+import asyncio
+import itertools
+import os
+import random
+import resource
+import time
+import tracemalloc
+from collections import defaultdict
+from typing import Dict, List
+
+# Конфиг читается при импорте — ключи нужны до импорта модулей бота
+os.environ.setdefault("TELEGRAM_TOKEN", "123456:BENCH")
+os.environ.setdefault("YANDEX_API_KEY", "bench")
+os.environ.setdefault("YANDEX_FOLDER_ID", "bench")
+
+from aiogram import Bot, Dispatcher  # noqa: E402
+from aiogram.client.session.aiohttp import AiohttpSession  # noqa: E402
+from aiogram.client.telegram import TelegramAPIServer  # noqa: E402
+from aiogram.types import Update  # noqa: E402
+
+import yandex_service  # noqa: E402
+from bench.stub import StubServer  # noqa: E402
+from handlers import register_handlers  # noqa: E402
+from state_manager import state_manager  # noqa: E402
+from yandex_service import YandexService  # noqa: E402
+from classifier import classifier  # noqa: E402
+from catalog import catalog  # noqa: E402
+from config import TG_CHAT_RPS, TG_CHAT_BURST, TG_GLOBAL_RPS, TG_GLOBAL_BURST, TG_MAX_RETRIES  # noqa: E402
+from middlewares import FloodControlMiddleware  # noqa: E402
+
+PANTRIES = [
+    "курица, картошка, лук",
+    "яйца, молоко, мука",
+    "фарш, рис, морковь, лук",
+    "свекла, капуста, картофель, морковь",
+    "творог, яйца, сахар",
+    "макароны, сыр, помидоры",
+]
+
+STEPS = ("products", "style", "category", "dish")
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+class LoadRunner:
+    def __init__(self, bot: Bot, dp: Dispatcher, unique_ratio: float):
+        self.bot = bot
+        self.dp = dp
+        self.unique_ratio = unique_ratio
+        self._ids = itertools.count(1)
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Dict[str, int] = defaultdict(int)
+
+    # --- СИНТЕТИЧЕСКИЕ АПДЕЙТЫ ---
+    def _user(self, user_id: int) -> dict:
+        return {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"}
+
+    def _message(self, user_id: int, text: str) -> Update:
+        n = next(self._ids)
+        return Update.model_validate({
+            "update_id": n,
+            "message": {
+                "message_id": n, "date": int(time.time()), "text": text,
+                "chat": {"id": user_id, "type": "private"}, "from": self._user(user_id),
+            },
+        }, context={"bot": self.bot})
+
+    def _callback(self, user_id: int, data: str) -> Update:
+        n = next(self._ids)
+        return Update.model_validate({
+            "update_id": n,
+            "callback_query": {
+                "id": str(n), "chat_instance": str(user_id), "data": data, "from": self._user(user_id),
+                "message": {
+                    "message_id": n, "date": int(time.time()), "text": "menu",
+                    "chat": {"id": user_id, "type": "private"}, "from": self._user(0),
+                },
+            },
+        }, context={"bot": self.bot})
+
+    async def _step(self, name: str, update: Update):
+        start = time.perf_counter()
+        try:
+            await self.dp.feed_update(self.bot, update)
+        except Exception:
+            self.errors[name] += 1
+        self.latencies[name].append(time.perf_counter() - start)
+
+    async def session(self, user_id: int):
+        """Полная сессия одного пользователя."""
+        if random.random() < self.unique_ratio:
+            pantry = f"{random.choice(PANTRIES)}, продукт{user_id}"
+        else:
+            pantry = random.choice(PANTRIES)
+        await self._step("products", self._message(user_id, pantry))
+        await self._step("style", self._callback(user_id, random.choice(["style_ordinary", "style_exotic"])))
+        await self._step("category", self._callback(user_id, "cat_main"))
+        await self._step("dish", self._callback(user_id, f"dish_{random.randint(0, 4)}"))
+
+    async def round(self, users: range, concurrency: int):
+        sem = asyncio.Semaphore(concurrency)
+
+        async def run(user_id: int):
+            async with sem:
+                await self.session(user_id)
+
+        await asyncio.gather(*(run(u) for u in users))
+
+
+def print_report(runner: LoadRunner, stub: StubServer, elapsed: float, sessions: int, memory: List[dict]):
+    updates = sum(len(v) for v in runner.latencies.values())
+    print("\n=== Throughput ===")
+    print(f"sessions: {sessions} in {elapsed:.1f}s -> {sessions / elapsed:.1f} sessions/s, {updates / elapsed:.1f} updates/s")
+    print("\n=== Step latency, s ===")
+    print(f"{'step':<10}{'count':>8}{'p50':>9}{'p95':>9}{'p99':>9}{'max':>9}{'errors':>8}")
+    for step in STEPS:
+        values = runner.latencies.get(step, [])
+        print(f"{step:<10}{len(values):>8}{percentile(values, .5):>9.3f}{percentile(values, .95):>9.3f}"
+              f"{percentile(values, .99):>9.3f}{max(values, default=0):>9.3f}{runner.errors.get(step, 0):>8}")
+    print("\n=== Memory by round ===")
+    print(f"{'round':<7}{'traced MiB':>12}{'peak MiB':>10}{'maxrss MiB':>12}{'sessions':>10}{'sess KiB':>10}")
+    for row in memory:
+        print(f"{row['round']:<7}{row['current'] / 2**20:>12.1f}{row['peak'] / 2**20:>10.1f}"
+              f"{row['maxrss'] / 1024:>12.1f}{row['sessions']:>10}{row['sessions_bytes'] / 1024:>10.0f}")
+    print("\n=== Upstream ===")
+    print(f"stub requests: {stub.requests}")
+    print(f"bot api calls: {stub.telegram_methods}")
+    print(f"caches: {YandexService.cache_stats()}")
+    print(f"scheduler: {YandexService.scheduler.stats()}")
+    print(f"single-flight: {YandexService.flights.stats()}")
+    print(f"local classifier: {classifier.stats()}")
+    print(f"recipe catalog: {catalog.stats()}")
+
+
+async def main(args):
+    random.seed(args.seed)
+    stub = StubServer(args.latency, args.jitter, args.error_rate, args.chunk_delay)
+    base = await stub.start()
+    yandex_service.GPT_URL = f"{base}/gpt"
+    yandex_service.STT_URL = f"{base}/stt"
+
+    bot = Bot(token=os.environ["TELEGRAM_TOKEN"], session=AiohttpSession(api=TelegramAPIServer.from_base(base)))
+    bot.session.middleware(FloodControlMiddleware(TG_CHAT_RPS, TG_CHAT_BURST, TG_GLOBAL_RPS, TG_GLOBAL_BURST, TG_MAX_RETRIES))
+    dp = Dispatcher()
+    register_handlers(dp)
+    await YandexService.start()
+    await state_manager.open()
+
+    runner = LoadRunner(bot, dp, args.unique_ratio)
+    tracemalloc.start()
+    memory = []
+    started = time.perf_counter()
+    for r in range(args.rounds):
+        first = r * args.users + 1
+        await runner.round(range(first, first + args.users), args.concurrency)
+        current, peak = tracemalloc.get_traced_memory()
+        memory.append({
+            "round": r + 1, "current": current, "peak": peak,
+            "maxrss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            "sessions": state_manager.session_count(), "sessions_bytes": state_manager.memory_usage(),
+        })
+        print(f"round {r + 1}/{args.rounds} done")
+    elapsed = time.perf_counter() - started
+    tracemalloc.stop()
+
+    print_report(runner, stub, elapsed, args.users * args.rounds, memory)
+
+    await state_manager.close()
+    await YandexService.close()
+    await bot.session.close()
+    await stub.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline load test of the bot")
+    parser.add_argument("--users", type=int, default=100, help="Сессий за раунд")
+    parser.add_argument("--concurrency", type=int, default=20, help="Одновременных пользователей")
+    parser.add_argument("--rounds", type=int, default=3, help="Раундов (для наблюдения за ростом памяти)")
+    parser.add_argument("--latency", type=float, default=0.3, help="Средняя задержка заглушки GPT, сек")
+    parser.add_argument("--jitter", type=float, default=0.1)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--chunk-delay", type=float, default=0.02)
+    parser.add_argument("--unique-ratio", type=float, default=0.5, help="Доля уникальных наборов продуктов (остальные бьют в кеш)")
+    parser.add_argument("--seed", type=int, default=1)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,159 @@
+"""Локальная заглушка внешних API для нагрузочных тестов.
+
+Отвечает на те же запросы, что и YandexGPT / SpeechKit / Telegram Bot API, с настраиваемой
+задержкой и долей ошибок. Можно запустить отдельно:
+
+    python -m bench.stub --port 8099 --latency 0.8 --error-rate 0.05
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import random
+import time
+from typing import Dict
+from aiohttp import web
+
+# --- ЗАГОТОВЛЕННЫЕ ОТВЕТЫ GPT ---
+CATEGORIES_REPLY = '["main", "soup", "salad"]'
+DISHES_REPLY = json.dumps([
+    {"name": "Курица с картофелем", "desc": "Запеченная в духовке с луком"},
+    {"name": "Куриный суп", "desc": "Легкий бульон с овощами"},
+    {"name": "Жаркое по-домашнему", "desc": "Тушеная картошка с мясом"},
+    {"name": "Котлеты", "desc": "Рубленые, с луком"},
+    {"name": "Драники", "desc": "Картофельные оладьи"},
+], ensure_ascii=False)
+VALID_REPLY = '{"valid": true}'
+INTENT_REPLY = '{"intent": "add_products", "products": "морковь", "dish_name": ""}'
+RECIPE_REPLY = (
+    "🍽️ Курица с картофелем\n\n🛒 Ингредиенты:\n- курица 500 г\n- картофель 600 г\n- лук 1 шт\n\n"
+    "👨‍🍳 Приготовление:\n" + "\n".join(f"{i}. Шаг приготовления номер {i}, подробно и понятно." for i in range(1, 9))
+    + "\n\n🎓 СОВЕТ ШЕФА: добавьте маринованный лук для кислотности."
+)
+
+
+def analysis_reply(user_text: str) -> str:
+    """Ответ объединенного анализа: продукты берем прямо из сообщения пользователя."""
+    products = [p.strip(' ".') for p in user_text.split(":", 1)[-1].split(",")]
+    return json.dumps({
+        "valid": True, "intent": "add_products", "products": [p for p in products if p],
+        "dish_name": "", "categories": ["main", "soup", "salad"],
+    }, ensure_ascii=False)
+
+
+def pick_reply(system_prompt: str, user_text: str = "") -> str:
+    """Ответ по содержимому системного промпта (того, что шлет YandexService)."""
+    if "модератор кулинарного бота" in system_prompt:
+        return analysis_reply(user_text)
+    if "JSON список ключей" in system_prompt:
+        return CATEGORIES_REPLY
+    if "Придумай" in system_prompt:
+        return DISHES_REPLY
+    if "модерация" in system_prompt:
+        return VALID_REPLY
+    if "Intent" in system_prompt:
+        return INTENT_REPLY
+    return RECIPE_REPLY
+
+
+class StubServer:
+    def __init__(self, latency: float = 0.5, jitter: float = 0.2, error_rate: float = 0.0, chunk_delay: float = 0.05):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.chunk_delay = chunk_delay
+        self.requests = {"gpt": 0, "gpt_stream": 0, "stt": 0, "telegram": 0, "errors": 0}
+        self.telegram_methods: Dict[str, int] = {}
+        self._message_ids = itertools.count(1000)
+        self.app = web.Application()
+        self.app.router.add_post("/gpt", self.gpt)
+        self.app.router.add_post("/stt", self.stt)
+        self.app.router.add_post("/bot{token}/{method}", self.telegram)
+        self._runner = None
+
+    async def _delay(self):
+        await asyncio.sleep(max(0.0, random.gauss(self.latency, self.jitter)))
+
+    def _fail(self) -> bool:
+        if random.random() < self.error_rate:
+            self.requests["errors"] += 1
+            return True
+        return False
+
+    # --- YANDEX GPT ---
+    async def gpt(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        text = pick_reply(body["messages"][0]["text"], body["messages"][1]["text"])
+        await self._delay()
+        if self._fail():
+            return web.json_response({"error": "stub overload"}, status=random.choice([429, 500, 503]))
+        if not body["completionOptions"].get("stream"):
+            self.requests["gpt"] += 1
+            return web.json_response({"result": {"alternatives": [{"message": {"role": "assistant", "text": text}}]}})
+
+        self.requests["gpt_stream"] += 1
+        resp = web.StreamResponse(headers={"Content-Type": "application/json"})
+        await resp.prepare(request)
+        step = max(1, len(text) // 10)
+        for end in range(step, len(text) + step, step):
+            status = "ALTERNATIVE_STATUS_FINAL" if end >= len(text) else "ALTERNATIVE_STATUS_PARTIAL"
+            chunk = {"result": {"alternatives": [{"message": {"role": "assistant", "text": text[:end]}, "status": status}]}}
+            await resp.write((json.dumps(chunk, ensure_ascii=False) + "\n").encode())
+            await asyncio.sleep(self.chunk_delay)
+        await resp.write_eof()
+        return resp
+
+    # --- SPEECHKIT ---
+    async def stt(self, request: web.Request) -> web.Response:
+        await request.read()
+        await self._delay()
+        if self._fail():
+            return web.json_response({"error": "stub overload"}, status=500)
+        self.requests["stt"] += 1
+        return web.json_response({"result": "курица, картошка, лук"})
+
+    # --- TELEGRAM BOT API ---
+    async def telegram(self, request: web.Request) -> web.Response:
+        self.requests["telegram"] += 1
+        method = request.match_info["method"].lower()
+        self.telegram_methods[method] = self.telegram_methods.get(method, 0) + 1
+        data = dict(await request.post())
+        if method in ("sendmessage", "editmessagetext"):
+            chat_id = int(data.get("chat_id") or 0)
+            message_id = int(data["message_id"]) if "message_id" in data else next(self._message_ids)
+            return web.json_response({"ok": True, "result": {
+                "message_id": message_id,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "text": data.get("text", ""),
+            }})
+        return web.json_response({"ok": True, "result": True})
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        self._runner = web.AppRunner(self.app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        return f"http://{host}:{port}"
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+
+async def _serve(args):
+    stub = StubServer(args.latency, args.jitter, args.error_rate, args.chunk_delay)
+    base = await stub.start(port=args.port)
+    print(f"Stub on {base}: GPT {base}/gpt, STT {base}/stt, Bot API {base}/bot<token>/<method>")
+    await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Yandex GPT/STT + Bot API stub")
+    parser.add_argument("--port", type=int, default=8099)
+    parser.add_argument("--latency", type=float, default=0.5, help="Средняя задержка ответа, сек")
+    parser.add_argument("--jitter", type=float, default=0.2)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--chunk-delay", type=float, default=0.05, help="Пауза между чанками в stream-режиме")
+    asyncio.run(_serve(parser.parse_args()))
@@ -0,0 +1,199 @@
+import logging
+import time
+import zlib
+from collections import OrderedDict, defaultdict
+from typing import Any, Dict, FrozenSet, Iterable, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class TTLCache:
+    """LRU-кеш в памяти с временем жизни записей и счетчиками попаданий."""
+
+    def __init__(self, name: str, maxsize: int, ttl: float):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # key -> (expires_at, value). Время настенное, чтобы снапшот пережил рестарт
+        self._data: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: str) -> Optional[Any]:
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return None
+        expires_at, value = item
+        if expires_at < time.time():
+            del self._data[key]
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: str, value: Any):
+        if self.maxsize <= 0:
+            return
+        self._data[key] = (time.time() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        self._data.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": round(self.hits / total, 3) if total else 0.0,
+        }
+
+    # --- СНАПШОТ ---
+    def dump(self) -> list:
+        now = time.time()
+        return [[k, exp, v] for k, (exp, v) in self._data.items() if exp > now]
+
+    def restore(self, entries: list) -> int:
+        """Поднимает записи из dump(). Уже имеющиеся ключи свежее — их не трогаем; поднятые
+        записи встают в хвост LRU и вытесняются первыми. Возвращает число поднятых."""
+        now = time.time()
+        restored = 0
+        for key, expires_at, value in reversed(entries):
+            if expires_at > now and key not in self._data:
+                self._data[key] = (expires_at, value)
+                self._data.move_to_end(key, last=False)
+                restored += 1
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+        return restored
+
+
+# --- КЕШ ПО ПОХОЖЕСТИ НАБОРОВ ПРОДУКТОВ ---
+_MERSENNE = (1 << 61) - 1
+# Фиксированные коэффициенты хеш-функций MinHash (одинаковые во всех процессах)
+_PERMUTATIONS = [((i * 0x9E3779B1 + 0x7F4A7C15) % _MERSENNE or 1, (i * 0x85EBCA77 + 0xC2B2AE3D) % _MERSENNE)
+                 for i in range(1, 129)]
+REPORT_THRESHOLDS = (0.5, 0.6, 0.7, 0.8, 0.9, 1.0)
+
+
+def jaccard(a: FrozenSet[str], b: FrozenSet[str]) -> float:
+    if not a and not b:
+        return 1.0
+    return len(a & b) / len(a | b)
+
+
+class SimilarityCache:
+    """Кеш, который отдает ответ для ПОХОЖЕГО набора продуктов.
+
+    "курица, рис, морковь" и "рис, курица, морковка, лук" — разные точные ключи, но сходство
+    по Жаккару 0.75. Кандидатов ищем через MinHash + LSH (полосы сигнатуры), затем считаем точный
+    Жаккар и берем лучший не ниже threshold. scope отделяет несовместимые ответы (категория, стиль).
+
+    Для подбора порога stats() показывает, какой была бы доля попаданий при каждом из REPORT_THRESHOLDS.
+    """
+
+    def __init__(self, name: str, maxsize: int, ttl: float, threshold: float, num_perm: int = 32, bands: int = 16):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = max(1, num_perm // bands)
+        self._perms = _PERMUTATIONS[:self.bands * self.rows]
+        self._ids = 0
+        # id -> (expires_at, scope, набор, полосы сигнатуры, value)
+        self._data: "OrderedDict[int, Tuple[float, str, FrozenSet[str], List[int], Any]]" = OrderedDict()
+        self._buckets: Dict[Tuple[str, int, int], Set[int]] = defaultdict(set)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._would_hit = {t: 0 for t in REPORT_THRESHOLDS}
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def _bands(self, items: FrozenSet[str]) -> List[int]:
+        hashes = [zlib.crc32(i.encode("utf-8")) for i in items] or [0]
+        signature = [min((a * h + b) % _MERSENNE for h in hashes) for a, b in self._perms]
+        return [hash(tuple(signature[i:i + self.rows])) for i in range(0, len(signature), self.rows)]
+
+    def _drop(self, entry_id: int):
+        _, scope, _, bands, _ = self._data.pop(entry_id)
+        for band, h in enumerate(bands):
+            bucket = self._buckets.get((scope, band, h))
+            if bucket is not None:
+                bucket.discard(entry_id)
+                if not bucket:
+                    del self._buckets[(scope, band, h)]
+
+    def get(self, scope: str, items: Iterable[str]) -> Optional[Any]:
+        items = frozenset(items)
+        candidates = set()
+        for band, h in enumerate(self._bands(items)):
+            candidates |= self._buckets.get((scope, band, h), set())
+
+        now = time.time()
+        best_id, best_score = None, 0.0
+        for entry_id in candidates:
+            expires_at, _, stored, _, _ = self._data[entry_id]
+            if expires_at < now:
+                self._drop(entry_id)
+                continue
+            score = jaccard(items, stored)
+            if score > best_score:
+                best_id, best_score = entry_id, score
+
+        for t in REPORT_THRESHOLDS:
+            if best_id is not None and best_score >= t:
+                self._would_hit[t] += 1
+        if best_id is None or best_score < self.threshold:
+            self.misses += 1
+            return None
+        self._data.move_to_end(best_id)
+        self.hits += 1
+        return self._data[best_id][4]
+
+    def set(self, scope: str, items: Iterable[str], value: Any):
+        if self.maxsize <= 0:
+            return
+        items = frozenset(items)
+        bands = self._bands(items)
+        # Тот же набор в том же scope — заменяем, а не плодим дубликаты
+        for entry_id in list(self._buckets.get((scope, 0, bands[0]), ())):
+            if self._data[entry_id][2] == items:
+                self._drop(entry_id)
+        self._ids += 1
+        self._data[self._ids] = (time.time() + self.ttl, scope, items, bands, value)
+        for band, h in enumerate(bands):
+            self._buckets[(scope, band, h)].add(self._ids)
+        while len(self._data) > self.maxsize:
+            self._drop(next(iter(self._data)))
+            self.evictions += 1
+
+    def clear(self):
+        self._data.clear()
+        self._buckets.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": round(self.hits / total, 3) if total else 0.0,
+            "threshold": self.threshold,
+            "hit_ratio_at": {t: round(n / total, 3) if total else 0.0 for t, n in self._would_hit.items()},
+        }
+
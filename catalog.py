@@ -0,0 +1,271 @@
+"""Встроенный каталог блюд: мгновенный ответ без GPT для типовых наборов продуктов.
+
+Исходник — data/recipes.json (блюда, синонимы продуктов, базовые продукты). Он собирается
+в компактный бинарный файл, который читается через mmap: страницы файла общие для всех
+процессов бота, в памяти каждого процесса остаются только смещения.
+
+    python catalog.py                      # data/recipes.json -> data/recipes.bin
+    python catalog.py "курица, картошка"   # проверить, что каталог ответит
+"""
+import json
+import logging
+import mmap
+import os
+import struct
+import sys
+import tempfile
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+from products import fold, split_products
+from config import CATALOG_SOURCE, CATALOG_PATH, CATALOG_MIN_COVERAGE, CATALOG_MIN_DISHES
+
+logger = logging.getLogger(__name__)
+
+# --- ФОРМАТ ФАЙЛА ---
+# Заголовок, затем таблицы фиксированной длины и общий блок данных (постинги uint16 + строки utf-8):
+#   terms:       ключ продукта (отсортирован по байтам) -> id ингредиента
+#   ingredients: id ингредиента -> список id блюд, где он нужен (постинг)
+#   dishes:      название, описание, категория и число ингредиентов блюда
+MAGIC = b"W2EC"
+VERSION = 1
+_HEADER = struct.Struct("<4sHIII")     # magic, version, n_terms, n_ingredients, n_dishes
+_TERM = struct.Struct("<IHH")          # key_off, key_len, ingredient_id
+_INGREDIENT = struct.Struct("<IH")     # postings_off, postings_len
+_DISH = struct.Struct("<IHIHIHB")      # name, desc, category (off, len), n_ingredients
+_ID = struct.Struct("<H")
+BASIC = 0xFFFF                         # id для соли/воды/масла: такие продукты просто пропускаем
+
+
+def term_key(item: str) -> str:
+    """Ключ продукта в индексе: основы слов в алфавитном порядке ("огурцы соленые" == "соленый огурец")."""
+    return " ".join(sorted(fold(item).split()))
+
+
+# --- СБОРКА ---
+def build(source: str = CATALOG_SOURCE, path: str = CATALOG_PATH) -> int:
+    """Собирает бинарный каталог из JSON. Пишет атомарно, возвращает число блюд."""
+    with open(source, encoding="utf-8") as f:
+        src = json.load(f)
+
+    ingredient_ids: Dict[str, int] = {}
+    terms: Dict[str, int] = {term_key(b): BASIC for b in src.get("basics", [])}
+    postings: Dict[int, List[int]] = defaultdict(list)
+    dishes = []
+    for dish_id, dish in enumerate(src["dishes"]):
+        ids = set()
+        for name in dish["ingredients"]:
+            key = term_key(name)
+            if terms.get(key) == BASIC:
+                continue
+            ing_id = ingredient_ids.setdefault(key, len(ingredient_ids))
+            terms.setdefault(key, ing_id)
+            ids.add(ing_id)
+        for ing_id in ids:
+            postings[ing_id].append(dish_id)
+        dishes.append((dish["name"], dish.get("desc", ""), dish["category"], len(ids)))
+    for canonical, aliases in src.get("aliases", {}).items():
+        ing_id = ingredient_ids.get(term_key(canonical))
+        if ing_id is None:
+            continue
+        for alias in aliases:
+            terms.setdefault(term_key(alias), ing_id)
+
+    # Смещения считаем от начала файла: сначала все таблицы, потом блок данных
+    sorted_terms = sorted(terms.items(), key=lambda kv: kv[0].encode("utf-8"))
+    data_start = (_HEADER.size + _TERM.size * len(sorted_terms)
+                  + _INGREDIENT.size * len(ingredient_ids) + _DISH.size * len(dishes))
+    blob = bytearray()
+
+    def put(raw: bytes) -> Tuple[int, int]:
+        off = data_start + len(blob)
+        blob.extend(raw)
+        return off, len(raw)
+
+    def put_str(text: str) -> Tuple[int, int]:
+        return put(text.encode("utf-8"))
+
+    out = bytearray(_HEADER.pack(MAGIC, VERSION, len(sorted_terms), len(ingredient_ids), len(dishes)))
+    for key, ing_id in sorted_terms:
+        out += _TERM.pack(*put_str(key), ing_id)
+    for ing_id in range(len(ingredient_ids)):
+        ids = postings[ing_id]
+        off, _ = put(b"".join(_ID.pack(d) for d in ids))
+        out += _INGREDIENT.pack(off, len(ids))
+    for name, desc, category, n_ings in dishes:
+        out += _DISH.pack(*put_str(name), *put_str(desc), *put_str(category), n_ings)
+    out += blob
+
+    # Свой временный файл у каждого процесса: воркеры могут пересобирать каталог одновременно
+    fd, tmp = tempfile.mkstemp(prefix=".recipes-", suffix=".tmp", dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        os.fchmod(fd, 0o644)
+        with os.fdopen(fd, "wb") as f:
+            f.write(out)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    logger.info(f"📖 Recipe catalog built: {len(dishes)} dishes, {len(sorted_terms)} terms -> {path}")
+    return len(dishes)
+
+
+# --- ЧТЕНИЕ ---
+class RecipeCatalog:
+    """Инвертированный индекс продукт -> блюда поверх mmap.
+
+    Покрытие блюда = доля его ингредиентов, которые есть у пользователя
+    (пересечение множеств id; соль, вода, масло и т.п. не считаются).
+    """
+
+    def __init__(self, path: str = CATALOG_PATH, source: str = CATALOG_SOURCE):
+        self.path = path
+        self.source = source
+        self._mm: Optional[mmap.mmap] = None
+        self.n_terms = self.n_ingredients = self.n_dishes = 0
+        self._ingredients_at = self._dishes_at = 0
+        self.hits = 0     # Ответили каталогом
+        self.misses = 0   # Покрытия не хватило — спрашиваем GPT
+
+    def open(self) -> bool:
+        """Открывает файл каталога (и пересобирает его, если исходник новее). False — каталога нет."""
+        if self._mm is not None:
+            return True
+        try:
+            if os.path.exists(self.source) and (
+                    not os.path.exists(self.path) or os.path.getmtime(self.source) > os.path.getmtime(self.path)):
+                build(self.source, self.path)
+            with open(self.path, "rb") as f:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, version, self.n_terms, self.n_ingredients, self.n_dishes = _HEADER.unpack_from(mm, 0)
+            if magic != MAGIC or version != VERSION:
+                mm.close()
+                logger.error(f"Recipe catalog {self.path}: unsupported format")
+                return False
+        except (OSError, ValueError, KeyError, struct.error) as e:
+            logger.error(f"Recipe catalog not loaded: {e}")
+            return False
+        self._mm = mm
+        self._ingredients_at = _HEADER.size + _TERM.size * self.n_terms
+        self._dishes_at = self._ingredients_at + _INGREDIENT.size * self.n_ingredients
+        logger.info(f"📖 Recipe catalog: {self.n_dishes} dishes ({self.path})")
+        return True
+
+    def close(self):
+        if self._mm is not None:
+            self._mm.close()
+            self._mm = None
+
+    def _str(self, off: int, length: int) -> str:
+        return self._mm[off:off + length].decode("utf-8")
+
+    def _lookup(self, key: str) -> Optional[int]:
+        """Двоичный поиск ключа продукта по отсортированной таблице terms."""
+        target = key.encode("utf-8")
+        lo, hi = 0, self.n_terms
+        while lo < hi:
+            mid = (lo + hi) // 2
+            off, length, ing_id = _TERM.unpack_from(self._mm, _HEADER.size + mid * _TERM.size)
+            probe = self._mm[off:off + length]
+            if probe == target:
+                return ing_id
+            if probe < target:
+                lo = mid + 1
+            else:
+                hi = mid
+        return None
+
+    def ingredient_ids(self, products: str) -> set:
+        """id ингредиентов каталога для продуктов пользователя."""
+        ids = set()
+        for item in split_products(products):
+            # Сначала продукт целиком ("сливочное масло"), потом пары и отдельные слова ("куриное филе" -> курица)
+            ing_id = self._lookup(term_key(item))
+            if ing_id is None:
+                words = fold(item).split()
+                pairs = [f"{a} {b}" for i, a in enumerate(words) for b in words[i + 1:]]
+                for candidate in pairs + words:
+                    ing_id = self._lookup(" ".join(sorted(candidate.split())))
+                    if ing_id is not None and ing_id != BASIC:
+                        ids.add(ing_id)
+                continue
+            if ing_id != BASIC:
+                ids.add(ing_id)
+        return ids
+
+    def _dish(self, dish_id: int) -> Tuple[str, str, str, int]:
+        name_off, name_len, desc_off, desc_len, cat_off, cat_len, n_ings = _DISH.unpack_from(
+            self._mm, self._dishes_at + dish_id * _DISH.size)
+        return self._str(name_off, name_len), self._str(desc_off, desc_len), self._str(cat_off, cat_len), n_ings
+
+    def match(self, products: str, min_coverage: float = CATALOG_MIN_COVERAGE) -> List[Tuple[float, int]]:
+        """[(покрытие, id блюда)] по убыванию покрытия, только блюда с покрытием >= min_coverage."""
+        if not self.open():
+            return []
+        counts: Dict[int, int] = defaultdict(int)
+        for ing_id in self.ingredient_ids(products):
+            off, length = _INGREDIENT.unpack_from(self._mm, self._ingredients_at + ing_id * _INGREDIENT.size)
+            for (dish_id,) in _ID.iter_unpack(self._mm[off:off + length * _ID.size]):
+                counts[dish_id] += 1
+        scored = []
+        for dish_id, hits in counts.items():
+            coverage = hits / max(1, self._dish(dish_id)[3])
+            if coverage >= min_coverage:
+                scored.append((coverage, hits, dish_id))
+        scored.sort(key=lambda s: (-s[0], -s[1], s[2]))
+        return [(coverage, dish_id) for coverage, _, dish_id in scored]
+
+    def servable(self, products: str) -> List[str]:
+        """Категории, где нашлось не меньше CATALOG_MIN_DISHES блюд (без учета в статистике)."""
+        counts: Dict[str, int] = defaultdict(int)
+        for _, dish_id in self.match(products):
+            counts[self._dish(dish_id)[2]] += 1
+        return [c for c, n in counts.items() if n >= CATALOG_MIN_DISHES]
+
+    def categories(self, products: str) -> List[str]:
+        """Категории, которые каталог сам покажет через dishes() (в каждой не меньше CATALOG_MIN_DISHES блюд).
+
+        Пусто — если таких нет: тогда категории подбирает GPT.
+        """
+        categories = self.servable(products)
+        if not categories:
+            self.misses += 1
+            return []
+        self.hits += 1
+        return categories
+
+    def dishes(self, products: str, category: str, limit: int = 6) -> List[Dict[str, str]]:
+        """Блюда категории в формате generate_dishes_list. Пусто — если их меньше CATALOG_MIN_DISHES."""
+        found = []
+        for _, dish_id in self.match(products):
+            name, desc, dish_category, _ = self._dish(dish_id)
+            if dish_category == category:
+                found.append({"name": name, "desc": desc})
+                if len(found) == limit:
+                    break
+        if len(found) < CATALOG_MIN_DISHES:
+            self.misses += 1
+            return []
+        self.hits += 1
+        return found
+
+    def stats(self) -> Dict[str, float]:
+        total = self.hits + self.misses
+        return {
+            "dishes": self.n_dishes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / total, 3) if total else 0.0,
+        }
+
+
+catalog = RecipeCatalog()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    build()
+    if len(sys.argv) > 1:
+        query = " ".join(sys.argv[1:])
+        for coverage, dish_id in catalog.match(query):
+            name, _, category, _ = catalog._dish(dish_id)
+            print(f"{coverage:.2f}  {category:<10} {name}")
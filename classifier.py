@@ -0,0 +1,146 @@
+import logging
+import os
+import re
+from typing import Dict, List, Optional
+from products import split_products, stem
+
+logger = logging.getLogger(__name__)
+
+LEXICON_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "food_lexicon.txt")
+
+# Слова, которые не меняют смысла списка продуктов ("у меня есть 2 кг картошки")
+STOP_WORDS = {
+    "у", "меня", "есть", "еще", "ещё", "и", "с", "со", "в", "на", "из", "для", "без", "немного", "много",
+    "чуть", "пара", "пару", "штук", "штуки", "шт", "кг", "г", "гр", "грамм", "граммов", "л", "мл", "литр",
+    "пачка", "пачки", "банка", "банки", "кусок", "кусочек", "головка", "зубчик", "пучок", "остался", "осталось",
+    "осталась", "остались", "только", "дома", "холодильнике", "а", "также", "тоже", "свежий", "свежая", "свежие",
+}
+
+# Сообщения, которые точно не список продуктов
+NON_FOOD_PHRASES = {
+    "привет", "здравствуйте", "здравствуй", "добрый день", "добрый вечер", "доброе утро", "хай", "hello", "hi",
+    "спасибо", "спс", "благодарю", "пока", "ок", "окей", "ok", "да", "нет", "кто ты", "что ты умеешь",
+    "как дела", "помощь", "help", "тест", "ага", "угу", "хм",
+}
+THANKS = {"спасибо", "спс", "благодарю", "спасибо большое", "благодарю вас"}
+
+# Насколько слово может быть длиннее словарной основы (картофел -> картофельн), чтобы считаться ею.
+# Короткие основы (рис, лук, сыр) должны совпасть целиком, иначе "рисунок" окажется едой
+MAX_SUFFIX = 2
+SHORT_STEM = 5
+_NON_LETTER_RE = re.compile(r"[^а-яёa-z\s-]+")
+
+
+class _Trie:
+    """Префиксное дерево основ: ищет самую длинную словарную основу, с которой начинается слово."""
+    __slots__ = ("root",)
+
+    def __init__(self):
+        self.root: Dict[str, dict] = {}
+
+    def add(self, word: str):
+        node = self.root
+        for ch in word:
+            node = node.setdefault(ch, {})
+        node["$"] = {}
+
+    def longest_prefix(self, word: str) -> int:
+        node, best = self.root, 0
+        for i, ch in enumerate(word, 1):
+            node = node.get(ch)
+            if node is None:
+                break
+            if "$" in node:
+                best = i
+        return best
+
+
+class LocalClassifier:
+    """Локальные ответы на очевидные случаи validate_ingredients / determine_intent.
+
+    Возвращает None, если не уверен — тогда спрашиваем LLM. Словарь грузится при первом вызове.
+    """
+
+    def __init__(self, path: str = LEXICON_PATH):
+        self.path = path
+        self._trie: Optional[_Trie] = None
+        self.resolved = 0   # Ответили сами
+        self.fallback = 0   # Отдали LLM
+
+    def _lexicon(self) -> _Trie:
+        if self._trie is None:
+            trie = _Trie()
+            count = 0
+            try:
+                with open(self.path, encoding="utf-8") as f:
+                    for line in f:
+                        word = line.strip().lower()
+                        if word and not word.startswith("#"):
+                            trie.add(stem(word))
+                            count += 1
+            except OSError as e:
+                logger.error(f"Food lexicon not loaded: {e}")
+            self._trie = trie
+            logger.info(f"📚 Food lexicon loaded: {count} words")
+        return self._trie
+
+    def is_food_word(self, word: str) -> bool:
+        word_stem = stem(word)
+        matched = self._lexicon().longest_prefix(word_stem)
+        if matched < 3:
+            return False
+        return len(word_stem) - matched <= (MAX_SUFFIX if matched >= SHORT_STEM else 0)
+
+    def extract_products(self, text: str) -> List[str]:
+        """Продукты из сообщения без служебных слов и количеств: "у меня 2 кг картошки" -> "картошки"."""
+        products = []
+        for item in split_products(text):
+            words = [w for w in _NON_LETTER_RE.sub(" ", item).split() if w not in STOP_WORDS]
+            if words:
+                products.append(" ".join(words))
+        return products
+
+    def _count(self, result):
+        if result is None:
+            self.fallback += 1
+        else:
+            self.resolved += 1
+        return result
+
+    def _check_ingredients(self, text: str) -> Optional[bool]:
+        normalized = _NON_LETTER_RE.sub(" ", text.lower()).strip()
+        if not normalized:
+            return False
+        if " ".join(normalized.split()) in NON_FOOD_PHRASES:
+            return False
+        items = self.extract_products(text)
+        if not items:
+            return None
+        # Каждое значимое слово должно быть из словаря, иначе решает LLM
+        if all(self.is_food_word(w) for item in items for w in item.split()):
+            return True
+        return None
+
+    def classify_ingredients(self, text: str) -> Optional[bool]:
+        """True/False — уверенный ответ, None — пусть решает LLM."""
+        return self._count(self._check_ingredients(text))
+
+    def classify_intent(self, text: str) -> Optional[str]:
+        """"thanks" / "add_products" — уверенный ответ, None — пусть решает LLM."""
+        phrase = " ".join(_NON_LETTER_RE.sub(" ", text.lower()).split())
+        if phrase in THANKS:
+            return self._count("thanks")
+        if self._check_ingredients(text):
+            return self._count("add_products")
+        return self._count(None)
+
+    def stats(self) -> Dict[str, float]:
+        total = self.resolved + self.fallback
+        return {
+            "resolved": self.resolved,
+            "fallback": self.fallback,
+            "local_ratio": round(self.resolved / total, 3) if total else 0.0,
+        }
+
+
+classifier = LocalClassifier()
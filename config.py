@@ -6,5 +6,112 @@ load_dotenv()
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 YANDEX_API_KEY = os.getenv("YANDEX_API_KEY")
 YANDEX_FOLDER_ID = os.getenv("YANDEX_FOLDER_ID")
+# Адреса API можно подменить (локальная заглушка для нагрузочных тестов, см. bench/)
+YANDEX_GPT_URL = os.getenv("YANDEX_GPT_URL", "https://llm.api.cloud.yandex.net/foundationModels/v1/completion")
+YANDEX_STT_URL = os.getenv("YANDEX_STT_URL", "https://stt.api.cloud.yandex.net/speech/v1/stt:recognize")
 
-MAX_HISTORY_MESSAGES = 4
\ No newline at end of file
+MAX_HISTORY_MESSAGES = 4
+MAX_PRODUCTS = int(os.getenv("MAX_PRODUCTS", 40))  # Сколько продуктов помним на пользователя
+
+# --- HTTP-КЛИЕНТ YANDEX ---
+HTTP_POOL_LIMIT = int(os.getenv("HTTP_POOL_LIMIT", 100))              # Всего соединений в пуле
+HTTP_POOL_LIMIT_PER_HOST = int(os.getenv("HTTP_POOL_LIMIT_PER_HOST", 20))
+HTTP_KEEPALIVE_TIMEOUT = float(os.getenv("HTTP_KEEPALIVE_TIMEOUT", 60))  # Сколько держим простаивающее соединение
+HTTP_DNS_CACHE_TTL = int(os.getenv("HTTP_DNS_CACHE_TTL", 300))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", 5))
+GPT_TIMEOUT = float(os.getenv("GPT_TIMEOUT", 60))                     # Таймаут одного запроса к GPT
+STT_TIMEOUT = float(os.getenv("STT_TIMEOUT", 20))
+
+# --- ГОЛОСОВЫЕ ---
+VOICE_MAX_DURATION = int(os.getenv("VOICE_MAX_DURATION", 30))        # Сек; больше синхронное распознавание не примет
+VOICE_MAX_BYTES = int(os.getenv("VOICE_MAX_BYTES", 1024 * 1024))     # Лимит размера файла для STT
+STT_CACHE_MAX_ITEMS = int(os.getenv("STT_CACHE_MAX_ITEMS", 5000))   # Распознанные голосовые по file_unique_id
+
+# --- КЕШ ОТВЕТОВ GPT ---
+CACHE_MAX_ITEMS = int(os.getenv("CACHE_MAX_ITEMS", 2000))  # Записей в каждом кеше
+CACHE_TTL = float(os.getenv("CACHE_TTL", 6 * 3600))         # Время жизни записи, сек
+SIMILAR_CACHE_THRESHOLD = float(os.getenv("SIMILAR_CACHE_THRESHOLD", 0.75))  # Жаккар продуктов для ответа по похожему набору (>1 = выкл.)
+SIMILAR_CACHE_MAX_ITEMS = int(os.getenv("SIMILAR_CACHE_MAX_ITEMS", 5000))
+SIMILAR_CACHE_TTL = float(os.getenv("SIMILAR_CACHE_TTL", 3 * 3600))
+
+# --- СЕССИИ ПОЛЬЗОВАТЕЛЕЙ ---
+SESSION_TTL = float(os.getenv("SESSION_TTL", 24 * 3600))             # Простой, после которого сессия удаляется
+MAX_SESSIONS = int(os.getenv("MAX_SESSIONS", 50000))                 # Потолок сессий в памяти (LRU)
+SESSION_SWEEP_INTERVAL = float(os.getenv("SESSION_SWEEP_INTERVAL", 300))
+
+# --- ХРАНИЛИЩЕ СЕССИЙ ---
+STATE_BACKEND = os.getenv("STATE_BACKEND", "memory")        # memory | sqlite (общий файл для нескольких процессов)
+STATE_DB_PATH = os.getenv("STATE_DB_PATH", "sessions.db")
+
+# --- WEBHOOK ---
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")                       # Публичный адрес сервиса (пусто = long polling)
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")                 # Пусто = генерируется при старте
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", 1000)) # Очередь апдейтов; при переполнении отвечаем 503
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", 16))         # Сколько апдейтов обрабатываем параллельно
+
+# --- НЕСКОЛЬКО ПРОЦЕССОВ (только webhook) ---
+WORKERS = int(os.getenv("WORKERS", 1))                       # >1 — супервизор принимает апдейты и раздает их N воркерам
+WORKER_BASE_PORT = int(os.getenv("WORKER_BASE_PORT", 9100))  # Воркер i слушает 127.0.0.1:WORKER_BASE_PORT+i
+WORKER_INDEX = int(os.getenv("WORKER_INDEX", -1))            # Номер воркера (выставляет супервизор); -1 = обычный процесс
+WORKER_HEALTH_INTERVAL = float(os.getenv("WORKER_HEALTH_INTERVAL", 5))  # Как часто опрашиваем /health воркеров
+WORKER_RESTART_BACKOFF = float(os.getenv("WORKER_RESTART_BACKOFF", 1))  # Пауза перед перезапуском упавшего (растет до 30 с)
+HASH_RING_REPLICAS = int(os.getenv("HASH_RING_REPLICAS", 64))           # Виртуальных узлов на воркер в кольце
+
+# --- ОСТАНОВКА И ТЕПЛЫЙ СТАРТ ---
+SHUTDOWN_TIMEOUT = float(os.getenv("SHUTDOWN_TIMEOUT", 20))  # Сколько ждем доработки хэндлеров после SIGTERM (Render дает 30)
+# Снапшот сессий и кешей ответов между рестартами (пусто = без диска). CACHE_SNAPSHOT_PATH — старое имя
+SNAPSHOT_PATH = os.getenv("SNAPSHOT_PATH", os.getenv("CACHE_SNAPSHOT_PATH", ""))
+
+# --- СКЛЕЙКА СООБЩЕНИЙ С ПРОДУКТАМИ ---
+PRODUCTS_DEBOUNCE = float(os.getenv("PRODUCTS_DEBOUNCE", 1.2))  # Сек тишины, после которых обрабатываем накопленное (0 = сразу)
+
+# --- ПРЕДЗАГРУЗКА МЕНЮ ---
+PREFETCH_ENABLED = os.getenv("PREFETCH_ENABLED", "0") == "1"  # Генерировать блюда всех категорий заранее
+PREFETCH_CONCURRENCY = int(os.getenv("PREFETCH_CONCURRENCY", 4)) # Сколько таких запросов одновременно (на процесс)
+
+# --- ВСТРОЕННЫЙ КАТАЛОГ БЛЮД ---
+CATALOG_ENABLED = os.getenv("CATALOG_ENABLED", "1") == "1"             # Отвечать каталогом без GPT, где это возможно
+CATALOG_SOURCE = os.getenv("CATALOG_SOURCE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "recipes.json"))
+CATALOG_PATH = os.getenv("CATALOG_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "recipes.bin"))
+CATALOG_MIN_COVERAGE = float(os.getenv("CATALOG_MIN_COVERAGE", 0.75))  # Доля ингредиентов блюда, которые должны быть у пользователя
+CATALOG_MIN_DISHES = int(os.getenv("CATALOG_MIN_DISHES", 3))           # Меньше совпадений — спрашиваем GPT
+CATALOG_BLEND = os.getenv("CATALOG_BLEND", "0") == "1"                 # Дополнять меню каталога идеями GPT в фоне (лишний запрос)
+
+# --- ПОТОКОВАЯ ГЕНЕРАЦИЯ РЕЦЕПТОВ ---
+STREAM_RECIPES = os.getenv("STREAM_RECIPES", "1") == "1"              # Показывать рецепт по мере генерации
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", 1.5))  # Не чаще одного edit в N сек (лимиты Telegram)
+STREAM_MIN_DELTA = int(os.getenv("STREAM_MIN_DELTA", 80))             # Минимум новых символов для очередного edit
+
+# --- ИСХОДЯЩИЕ ЗАПРОСЫ К TELEGRAM ---
+TG_CHAT_RPS = float(os.getenv("TG_CHAT_RPS", 1))           # Сообщений/правок в секунду в один чат
+TG_CHAT_BURST = float(os.getenv("TG_CHAT_BURST", 3))
+TG_GLOBAL_RPS = float(os.getenv("TG_GLOBAL_RPS", 30))      # Общий лимит бота
+TG_GLOBAL_BURST = float(os.getenv("TG_GLOBAL_BURST", 30))
+TG_MAX_RETRIES = int(os.getenv("TG_MAX_RETRIES", 3))       # Повторов после 429 (ждем retry_after)
+TG_DELETE_DELAY = float(os.getenv("TG_DELETE_DELAY", 0.5)) # Удаления копятся столько секунд и уходят одним deleteMessages
+
+# --- ПЛАНИРОВЩИК ЗАПРОСОВ К YANDEX GPT ---
+YANDEX_RPS = float(os.getenv("YANDEX_RPS", 10))                 # Бюджет запросов в секунду (0 = без лимита)
+YANDEX_BURST = float(os.getenv("YANDEX_BURST", 10))
+YANDEX_CONCURRENCY = int(os.getenv("YANDEX_CONCURRENCY", 10))   # Одновременных запросов к GPT
+YANDEX_QUEUE_INTERACTIVE = int(os.getenv("YANDEX_QUEUE_INTERACTIVE", 200))  # Лимиты очередей по полосам
+YANDEX_QUEUE_NORMAL = int(os.getenv("YANDEX_QUEUE_NORMAL", 200))
+YANDEX_QUEUE_BACKGROUND = int(os.getenv("YANDEX_QUEUE_BACKGROUND", 20))
+YANDEX_MAX_RETRIES = int(os.getenv("YANDEX_MAX_RETRIES", 3))
+YANDEX_BACKOFF_BASE = float(os.getenv("YANDEX_BACKOFF_BASE", 0.5))
+YANDEX_BACKOFF_MAX = float(os.getenv("YANDEX_BACKOFF_MAX", 8))
+
+# --- МОДЕЛИ И МАРШРУТИЗАЦИЯ ---
+YANDEX_MODEL = os.getenv("YANDEX_MODEL", "yandexgpt/latest")
+YANDEX_MODEL_LITE = os.getenv("YANDEX_MODEL_LITE", "yandexgpt-lite/latest")
+# метод=модель:max_tokens через запятую; модель — lite, pro или полное имя. Не указанные методы идут в pro с 1500
+GPT_ROUTES = os.getenv("GPT_ROUTES", (
+    "validate_ingredients=lite:20,determine_intent=lite:150,analyze_categories=lite:60,analyze_input=lite:300,"
+    "generate_dishes_list=pro:800,generate_recipe=pro:1500,freestyle_recipe=pro:1500"
+))
+YANDEX_HEDGE = os.getenv("YANDEX_HEDGE", "0") == "1"                        # Дублировать медленный запрос
+YANDEX_HEDGE_DELAY = float(os.getenv("YANDEX_HEDGE_DELAY", 0))              # Через сколько сек (0 = p95 метода по метрикам)
+YANDEX_HEDGE_DEFAULT_DELAY = float(os.getenv("YANDEX_HEDGE_DEFAULT_DELAY", 3))  # Пока статистики мало
+YANDEX_HEDGE_MIN_SAMPLES = int(os.getenv("YANDEX_HEDGE_MIN_SAMPLES", 50))
+GPT_JSON_REASKS = int(os.getenv("GPT_JSON_REASKS", 1))                      # Переспросов, если JSON не починился
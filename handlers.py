@@ -1,12 +1,41 @@
-import io
+import asyncio
 import logging
+import time
+from typing import AsyncIterator, Dict, List, Optional
 from aiogram import Dispatcher, F
 from aiogram.filters import Command
-from aiogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
+from aiogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery, Update
 from yandex_service import YandexService
 from state_manager import state_manager
+from middlewares import StateSyncMiddleware, HandlerMetricsMiddleware, UserLaneMiddleware, update_tracker
+from prefetch import DishPrefetcher
+from catalog import catalog
+from outbound import deleter, show
+from scheduler import Priority, current_priority
+from config import PREFETCH_ENABLED, PREFETCH_CONCURRENCY, STREAM_RECIPES, STREAM_EDIT_INTERVAL, STREAM_MIN_DELTA
+from config import CATALOG_ENABLED, CATALOG_BLEND, VOICE_MAX_DURATION, VOICE_MAX_BYTES, STT_TIMEOUT, PRODUCTS_DEBOUNCE
 
 ai_service = YandexService()
+prefetcher = DishPrefetcher(PREFETCH_CONCURRENCY)
+# Фоновое дополнение меню из каталога идеями GPT: user_id -> задача
+blend_tasks: Dict[int, asyncio.Task] = {}
+
+
+class PendingInput:
+    """Сообщения с продуктами, пришедшие подряд, — ждут конца окна склейки."""
+    __slots__ = ("texts", "generation")
+
+    def __init__(self):
+        self.texts: List[str] = []
+        self.generation = 0
+
+
+# user_id -> накопленный ввод
+pending_inputs: Dict[int, PendingInput] = {}
+# user_id -> когда пришло последнее сообщение с продуктами (monotonic, по приходу в очередь пользователя)
+last_products_at: Dict[int, float] = {}
+LAST_PRODUCTS_LIMIT = 10000  # Больше записей — вычищаем тех, у кого окно уже закрылось
+THANKS = {"спасибо", "спс", "благодарю"}
 logger = logging.getLogger(__name__)
 
 # --- СЛОВАРЬ КАТЕГОРИЙ (Для отображения) ---
@@ -62,9 +91,37 @@ def get_recipe_back_keyboard():
 def get_hide_keyboard():
     return InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="🗑 Скрыть", callback_data="delete_msg")]])
 
+# --- ПОТОКОВЫЙ ВЫВОД ---
+
+TG_TEXT_LIMIT = 4096
+
+async def stream_into_message(wait: Message, chunks: AsyncIterator[str]) -> str:
+    """Показывает текст в сообщении wait по мере генерации. Возвращает последний (полный) текст.
+
+    Промежуточные правки идут без разметки (HTML может быть недописан) и не чаще STREAM_EDIT_INTERVAL.
+    """
+    text = ""
+    shown = ""
+    last_edit = time.monotonic()
+    async for text in chunks:
+        now = time.monotonic()
+        if now - last_edit < STREAM_EDIT_INTERVAL or len(text) - len(shown) < STREAM_MIN_DELTA:
+            continue
+        try:
+            await wait.edit_text(text[:TG_TEXT_LIMIT - 2] + " ▌")
+            shown = text
+        except Exception as e:
+            logger.warning(f"Stream edit skipped: {e}")
+        last_edit = now
+    return text
+
 # --- ХЭНДЛЕРЫ ---
 
 async def cmd_start(message: Message):
+    prefetcher.cancel(message.from_user.id)
+    cancel_blend(message.from_user.id)
+    pending_inputs.pop(message.from_user.id, None)
+    last_products_at.pop(message.from_user.id, None)
     state_manager.clear_session(message.from_user.id)
     text = (
         "👋 Здравствуйте.\n\n"
@@ -86,123 +143,281 @@ async def handle_direct_recipe(message: Message):
 
     wait = await message.answer(f"⚡️ Ищу: <b>{dish_name}</b>...", parse_mode="HTML")
     try:
-        recipe = await ai_service.generate_freestyle_recipe(dish_name)
-        await wait.delete()
         # Для прямых запросов "Назад" не актуален, оставляем "Скрыть"
-        await message.answer(recipe, reply_markup=get_hide_keyboard(), parse_mode="HTML")
+        if STREAM_RECIPES:
+            recipe = await stream_into_message(wait, ai_service.stream_freestyle_recipe(dish_name))
+        else:
+            recipe = await ai_service.generate_freestyle_recipe(dish_name)
+        if not recipe:
+            await show(message, "Ошибка генерации.", placeholder=wait)
+            return
+        await show(message, recipe, get_hide_keyboard(), placeholder=wait)
         state_manager.set_state(user_id, "recipe_sent")
     except Exception:
-        await wait.delete()
-        await message.answer("Ошибка генерации.")
+        await show(message, "Ошибка генерации.", placeholder=wait)
 
 async def handle_delete_msg(callback: CallbackQuery):
-    await callback.message.delete()
+    deleter.delete(callback.message)
     await callback.answer()
 
-async def handle_voice(message: Message):
+async def stream_voice(message: Message) -> AsyncIterator[bytes]:
+    """Голосовое кусками прямо из Bot API в тело запроса к STT — без копии файла в памяти."""
+    bot = message.bot
+    file = await bot.get_file(message.voice.file_id)
+    url = bot.session.api.file_url(bot.token, file.file_path)
+    received = 0
+    async for chunk in bot.session.stream_content(url=url, timeout=int(STT_TIMEOUT)):
+        received += len(chunk)
+        # file_size в апдейте бывает пустым — проверяем и по факту
+        if received > VOICE_MAX_BYTES:
+            raise ValueError(f"Voice note exceeds {VOICE_MAX_BYTES} bytes")
+        yield chunk
+
+async def handle_voice(message: Message, user_lane=None, arrived_at: float = None):
     user_id = message.from_user.id
+    voice = message.voice
+    # Лимиты проверяем до любых сетевых запросов
+    if voice.duration > VOICE_MAX_DURATION or (voice.file_size or 0) > VOICE_MAX_BYTES:
+        await message.answer(f"⏱ Голосовое слишком длинное. Уложитесь в {VOICE_MAX_DURATION} секунд.")
+        return
     processing_msg = await message.answer("🎧 Слушаю...")
     try:
-        voice_file = io.BytesIO()
-        await message.bot.download(message.voice, destination=voice_file)
-        text = await ai_service.speech_to_text(voice_file.getvalue())
-        await processing_msg.delete()
+        text = await ai_service.speech_to_text(stream_voice(message), voice.file_unique_id, voice.file_size)
         if not text:
-            await message.answer("😕 Тишина.")
+            await show(message, "😕 Тишина.", placeholder=processing_msg)
             return
-        try: await message.delete()
-        except: pass
-        await process_products_input(message, user_id, text)
+        # "Слушаю..." и само голосовое уходят одним deleteMessages
+        deleter.delete(processing_msg)
+        deleter.delete(message)
+        await process_products_input(message, user_id, text, user_lane, arrived_at)
     except Exception:
-        await processing_msg.delete()
-
-async def handle_text(message: Message):
-    await process_products_input(message, message.from_user.id, message.text)
+        deleter.delete(processing_msg)
+
+async def handle_text(message: Message, user_lane=None, arrived_at: float = None):
+    await process_products_input(message, message.from_user.id, message.text, user_lane, arrived_at)
+
+def is_products_update(update: Update) -> bool:
+    """Текст, который уйдет в process_products_input и заберет накопленный ввод.
+
+    Голосовое сюда не входит: распознавание может не получиться, и тогда буфер остался бы без хозяина.
+    """
+    text = update.message.text if update.message is not None else None
+    if not text or text.startswith("/") or text.lower().strip(" .!") in THANKS:
+        return False
+    return not text.lower().startswith("дай рецепт")
+
+def release_products_input(user_id: int, pending: Optional[PendingInput], user_lane=None):
+    """Хэндлер закончил с буфером (или его прервали). Текст остается в буфере, только если
+    хэндлер вытеснило следующее сообщение с продуктами — оно его и заберет."""
+    if user_lane is not None:
+        user_lane.interruptible = False
+        if user_lane.inputs > 1 and asyncio.current_task().cancelling():
+            return
+    if pending is not None and pending_inputs.get(user_id) is pending:
+        del pending_inputs[user_id]
+
+async def collect_products_input(user_id: int, text: str, arrived_at: float = None,
+                                 user_lane=None) -> Optional[PendingInput]:
+    """Копит сообщения, пришедшие одно за другим. Возвращает буфер, если обрабатывать его этому
+    хэндлеру, или None — если за этим сообщением пришло еще одно (тогда обработает оно).
+
+    Первое сообщение серии не ждет, но до конца анализа его может вытеснить следующее:
+    тогда оба текста уйдут одним проходом. Буфер освобождает release_products_input.
+    """
+    if arrived_at is None:
+        arrived_at = time.monotonic()
+    previous = last_products_at.get(user_id)
+    last_products_at[user_id] = arrived_at
+    if len(last_products_at) > LAST_PRODUCTS_LIMIT:
+        for uid, at in list(last_products_at.items()):
+            if arrived_at - at > PRODUCTS_DEBOUNCE:
+                del last_products_at[uid]
+    pending = pending_inputs.get(user_id)
+    if pending is None:
+        pending = pending_inputs[user_id] = PendingInput()
+    pending.texts.append(text)
+    pending.generation += 1
+    generation = pending.generation
+    # Следующее сообщение с продуктами уже ждет в очереди — оно заберет и этот текст
+    if user_lane is not None and user_lane.inputs > 1:
+        return None
+    if user_lane is not None:
+        user_lane.interruptible = True
+    if len(pending.texts) == 1 and (previous is None or arrived_at - previous > PRODUCTS_DEBOUNCE):
+        return pending
+    # Пользователь пишет подряд: ждем конца окна (от прихода сообщения, а не от начала обработки)
+    try:
+        await asyncio.sleep(max(0.0, arrived_at + PRODUCTS_DEBOUNCE - time.monotonic()))
+    except asyncio.CancelledError:
+        release_products_input(user_id, pending, user_lane)
+        raise
+    if pending_inputs.get(user_id) is not pending or pending.generation != generation:
+        return None
+    return pending
 
 # --- ГЛАВНАЯ ЛОГИКА ---
-async def process_products_input(message: Message, user_id: int, text: str):
+async def process_products_input(message: Message, user_id: int, text: str, user_lane=None,
+                                 arrived_at: float = None):
     # Пасхалка
-    if text.lower().strip(" .!") in ["спасибо", "спс", "благодарю"]:
+    if text.lower().strip(" .!") in THANKS:
         if state_manager.get_state(user_id) == "recipe_sent":
             await message.answer("На здоровье! 👨‍🍳")
             state_manager.clear_state(user_id)
             return
 
+    # Продукты, набранные несколькими сообщениями подряд, обрабатываем одним проходом
+    pending = None
+    if PRODUCTS_DEBOUNCE > 0:
+        pending = await collect_products_input(user_id, text, arrived_at, user_lane)
+        if pending is None:
+            return
+        text = ", ".join(pending.texts)
+    # Дописывание меню под старый набор продуктов больше не нужно
+    cancel_blend(user_id)
+
     if state_manager.get_state(user_id) == "recipe_sent":
         state_manager.clear_state(user_id)
 
     products_in_memory = state_manager.get_products(user_id)
-    
+    last_bot_msg = state_manager.get_last_bot_message(user_id) or ""
+    # Один запрос: и проверка (или намерение), и нормализованные продукты, и категории.
+    # Пока он идет, хэндлер может вытеснить следующее сообщение с продуктами — до этого места ничего не изменено
+    try:
+        if products_in_memory:
+            analysis = await ai_service.analyze_input(text, products_in_memory, last_bot_msg)
+        else:
+            analysis = await ai_service.analyze_input(text)
+    finally:
+        release_products_input(user_id, pending, user_lane)
+
     # 1. Если продуктов еще нет -> Сохраняем и спрашиваем стиль (старт сессии)
     if not products_in_memory:
-        is_valid = await ai_service.validate_ingredients(text)
-        if not is_valid:
+        if not analysis["valid"]:
             await message.answer(f"🤨 <b>\"{text}\"</b> — не похоже на продукты.", parse_mode="HTML")
             return
-        state_manager.set_products(user_id, text)
+        state_manager.set_products(user_id, ", ".join(analysis["products"]) or text)
+        state_manager.set_categories(user_id, analysis["categories"])
         state_manager.add_message(user_id, "user", text)
-        # Сразу предлагаем стиль, а анализ категорий будет после стиля
+        # Сразу предлагаем стиль, категории уже известны
         await message.answer(f"✅ Продукты приняты.\nКакой стиль готовки?", reply_markup=get_style_keyboard(), parse_mode="HTML")
         return
 
-    # 2. Если продукты уже есть -> Определяем намерение (добавка или бред)
-    last_bot_msg = state_manager.get_last_bot_message(user_id) or ""
-    intent_data = await ai_service.determine_intent(text, last_bot_msg)
-    
-    if intent_data.get("intent") == "add_products" or True: # Упрощаем: почти любой текст считаем добавкой
-        # Добавляем продукты и перезапускаем анализ категорий
-        state_manager.append_products(user_id, text)
+    # 2. Если продукты уже есть -> Определяем намерение (добавка или бред) и сразу категории
+    if analysis["intent"] == "add_products" or True: # Упрощаем: почти любой текст считаем добавкой
+        # Добавляем продукты и перезапускаем флоу категорий
+        state_manager.append_products(user_id, ", ".join(analysis["products"]) or text)
         await message.answer(f"➕ Добавил: <b>{text}</b>.", parse_mode="HTML")
         
-        # Запускаем флоу категорий заново (как будто стиль уже выбран "обычный")
+        # Запускаем флоу категорий заново (с ранее выбранным стилем, если он был)
         all_products = state_manager.get_products(user_id)
-        await start_category_flow(message, user_id, all_products, "с учетом новых продуктов")
+        style = state_manager.get_style(user_id) or "с учетом новых продуктов"
+        await start_category_flow(message, user_id, all_products, style, analysis["categories"])
 
 # --- ЛОГИКА КАТЕГОРИЙ И БЛЮД ---
 
-async def start_category_flow(message: Message, user_id: int, products: str, style: str):
-    wait = await message.answer("👨‍🍳 Анализирую продукты...")
+async def start_category_flow(message: Message, user_id: int, products: str, style: str, categories: list = None,
+                              placeholder: Message = None):
+    """placeholder — сообщение бота, которое можно переписать вместо отправки нового."""
+    # Предзагрузки под старый набор продуктов больше не нужны
+    prefetcher.cancel(user_id)
+    cancel_blend(user_id)
     
-    # 1. Получаем категории
-    categories = await ai_service.analyze_categories(products)
-    
-    await wait.delete()
+    # 1. Получаем категории (если их не принес объединенный анализ сообщения): сначала каталог, потом GPT
+    if not categories and CATALOG_ENABLED:
+        categories = catalog.categories(products)
+    if not categories:
+        placeholder = await show(message, "👨‍🍳 Анализирую продукты...", placeholder=placeholder)
+        categories = await ai_service.analyze_categories(products)
     
     if not categories:
-        await message.answer("Из этого сложно что-то приготовить. Добавьте еще продуктов.")
+        await show(message, "Из этого сложно что-то приготовить. Добавьте еще продуктов.", placeholder=placeholder)
         return
 
-    # Сохраняем категории
+    # Сохраняем категории и стиль (и сразу пишем в хранилище — кнопку могут нажать в другом процессе)
     state_manager.set_categories(user_id, categories)
+    state_manager.set_style(user_id, style)
+    await state_manager.commit(user_id)
 
     # 2. Если категория всего одна (например, только 'main') -> Сразу генерируем блюда
     if len(categories) == 1:
-        await show_dishes_for_category(message, user_id, products, categories[0], style)
+        await show_dishes_for_category(message, user_id, products, categories[0], style, placeholder)
     else:
-        # 3. Показываем меню выбора категорий
-        await message.answer("📂 <b>Что будем готовить?</b>", reply_markup=get_categories_keyboard(categories), parse_mode="HTML")
+        # 3. Пока пользователь выбирает, заранее генерируем блюда всех категорий
+        if PREFETCH_ENABLED:
+            # Категории, которые отдаст каталог, готовить через GPT незачем
+            served = catalog.servable(products) if CATALOG_ENABLED and style != "экзотический" else []
+            prefetcher.start(user_id, products, [c for c in categories if c not in served], style)
+        # 4. Показываем меню выбора категорий
+        await show(message, "📂 <b>Что будем готовить?</b>", get_categories_keyboard(categories), placeholder)
+
+def format_dishes_menu(cat_name: str, dishes_list: list) -> str:
+    response_text = f"🍽 <b>Меню: {cat_name}</b>\n\n"
+    for dish in dishes_list:
+        response_text += f"🔸 <b>{dish['name']}</b>\n<i>{dish['desc']}</i>\n\n"
+    return response_text
 
-async def show_dishes_for_category(message: Message, user_id: int, products: str, category: str, style: str):
+async def show_dishes_for_category(message: Message, user_id: int, products: str, category: str, style: str,
+                                   placeholder: Message = None):
+    cancel_blend(user_id)
     cat_name = CATEGORY_MAP.get(category, "Блюда")
-    wait = await message.answer(f"🍳 Придумываю {cat_name}...")
-    
-    dishes_list = await ai_service.generate_dishes_list(products, category, style)
+
+    # Классику для типовых продуктов отдаем из каталога сразу, экзотику придумывает GPT
+    dishes_list = None
+    if CATALOG_ENABLED and style != "экзотический":
+        dishes_list = catalog.dishes(products, category) or None
+    from_catalog = dishes_list is not None
+
+    if dishes_list is None:
+        placeholder = await show(message, f"🍳 Придумываю {cat_name}...", placeholder=placeholder)
+        dishes_list = await prefetcher.take(user_id, products, category, style)
+    if dishes_list is None:
+        dishes_list = await ai_service.generate_dishes_list(products, category, style)
     
     if not dishes_list:
-        await wait.delete()
-        await message.answer("Не удалось придумать рецепты. Попробуйте другую категорию.")
+        await show(message, "Не удалось придумать рецепты. Попробуйте другую категорию.", placeholder=placeholder)
         return
 
     state_manager.set_generated_dishes(user_id, dishes_list)
     
-    response_text = f"🍽 <b>Меню: {cat_name}</b>\n\n"
-    for dish in dishes_list:
-        response_text += f"🔸 <b>{dish['name']}</b>\n<i>{dish['desc']}</i>\n\n"
-    
+    response_text = format_dishes_menu(cat_name, dishes_list)
     state_manager.add_message(user_id, "bot", response_text)
+    # Индексы dish_N должны оказаться в хранилище раньше, чем пользователь увидит кнопки
+    await state_manager.commit(user_id)
     
-    await wait.delete()
-    await message.answer(response_text, reply_markup=get_dishes_keyboard(dishes_list), parse_mode="HTML")
+    sent = await show(message, response_text, get_dishes_keyboard(dishes_list), placeholder)
+
+    if from_catalog and CATALOG_BLEND:
+        task = asyncio.create_task(blend_gpt_dishes(sent, user_id, products, category, style, dishes_list))
+        blend_tasks[user_id] = task
+        task.add_done_callback(lambda t: blend_tasks.pop(user_id) if blend_tasks.get(user_id) is t else None)
+
+async def blend_gpt_dishes(sent: Message, user_id: int, products: str, category: str, style: str, dishes_list: list):
+    """Дописывает в показанное меню каталога блюда от GPT. Старые кнопки dish_N не сдвигаются."""
+    current_priority.set(Priority.BACKGROUND)
+    try:
+        extra = await ai_service.generate_dishes_list(products, category, style)
+        known = {d["name"].strip().lower() for d in dishes_list}
+        new = [d for d in extra if isinstance(d, dict) and d.get("name") and d["name"].strip().lower() not in known]
+        if not new:
+            return
+        merged = dishes_list + [{"name": d["name"], "desc": d.get("desc", "")} for d in new[:3]]
+        response_text = format_dishes_menu(CATEGORY_MAP.get(category, "Блюда"), merged)
+        # Задача идет вне очереди пользователя: если он уже ушел с этого меню, ничего не трогаем
+        if state_manager.get_generated_dishes(user_id) != dishes_list:
+            return
+        state_manager.set_generated_dishes(user_id, merged)
+        state_manager.add_message(user_id, "bot", response_text)
+        await state_manager.commit(user_id)
+        await sent.edit_text(response_text, reply_markup=get_dishes_keyboard(merged), parse_mode="HTML")
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        logger.warning(f"Menu blend skipped: {e}")
+
+def cancel_blend(user_id: int):
+    task = blend_tasks.pop(user_id, None)
+    if task is not None:
+        task.cancel()
 
 
 # --- CALLBACKS ---
@@ -212,6 +427,10 @@ async def handle_callback(callback: CallbackQuery):
     data = callback.data
     
     if data == "restart":
+        prefetcher.cancel(user_id)
+        cancel_blend(user_id)
+        pending_inputs.pop(user_id, None)
+        last_products_at.pop(user_id, None)
         state_manager.clear_session(user_id)
         await callback.message.answer("🗑 Жду продукты.")
         await callback.answer()
@@ -225,8 +444,10 @@ async def handle_callback(callback: CallbackQuery):
             await callback.message.answer("Список пуст. /start")
             return
         
-        await callback.message.delete()
-        await start_category_flow(callback.message, user_id, products, style)
+        # Категории уже посчитаны при приеме продуктов — второй запрос не нужен.
+        # Сообщение с кнопками стиля переписываем следующим шагом, а не удаляем
+        await start_category_flow(callback.message, user_id, products, style, state_manager.get_categories(user_id),
+                                  placeholder=callback.message)
         await callback.answer()
         return
 
@@ -234,30 +455,32 @@ async def handle_callback(callback: CallbackQuery):
     if data.startswith("cat_"):
         category = data.split("_")[1]
         products = state_manager.get_products(user_id)
-        # Стиль можно запомнить, но для простоты берем дефолт
-        await callback.message.delete()
-        await show_dishes_for_category(callback.message, user_id, products, category, "выбранный")
+        # Стиль запомнен в start_category_flow — с ним же шла предзагрузка
+        style = state_manager.get_style(user_id) or "выбранный"
+        await show_dishes_for_category(callback.message, user_id, products, category, style, placeholder=callback.message)
         await callback.answer()
         return
 
     # НАЗАД К КАТЕГОРИЯМ
     if data == "back_to_categories":
+        cancel_blend(user_id)
         categories = state_manager.get_categories(user_id)
         if not categories:
             await callback.answer("Сессия истекла. Начните заново.")
             return
         
-        await callback.message.delete()
         if len(categories) == 1:
             # Если категория одна, назад идти некуда, предлагаем рестарт или добавку
-            await callback.message.answer("Категория была одна. Добавьте продукты или начните заново.", reply_markup=get_categories_keyboard(categories))
+            text = "Категория была одна. Добавьте продукты или начните заново."
         else:
-            await callback.message.answer("📂 <b>Выберите категорию:</b>", reply_markup=get_categories_keyboard(categories), parse_mode="HTML")
+            text = "📂 <b>Выберите категорию:</b>"
+        await show(callback.message, text, get_categories_keyboard(categories), placeholder=callback.message)
         await callback.answer()
         return
 
     # ВЫБОР БЛЮДА
     if data.startswith("dish_"):
+        cancel_blend(user_id)
         try:
             index = int(data.split("_")[1])
             dish_name = state_manager.get_generated_dish(user_id, index)
@@ -270,16 +493,24 @@ async def handle_callback(callback: CallbackQuery):
             await callback.answer("Готовлю рецепт...")
             wait = await callback.message.answer(f"👨‍🍳 Пишу рецепт: <b>{dish_name}</b>...", parse_mode="HTML")
             
-            recipe = await ai_service.generate_recipe(dish_name, products)
-            await wait.delete()
+            if STREAM_RECIPES:
+                # Текст появляется в сообщении ожидания по мере генерации
+                recipe = await stream_into_message(wait, ai_service.stream_recipe(dish_name, products))
+            else:
+                recipe = await ai_service.generate_recipe(dish_name, products)
+            if not recipe:
+                # Ответ не пришел или оборвался: недописанный рецепт не показываем
+                await show(callback.message, "😕 Не получилось написать рецепт. Попробуйте еще раз.",
+                           get_recipe_back_keyboard(), placeholder=wait)
+                return
             
             # У старого сообщения убираем кнопки (чтобы не спамили)
             # await callback.message.edit_reply_markup(reply_markup=None) 
             
             state_manager.set_state(user_id, "recipe_sent")
             
-            # ТОЛЬКО КНОПКА ВОЗВРАТА
-            await callback.message.answer(recipe, reply_markup=get_recipe_back_keyboard(), parse_mode="HTML")
+            # ТОЛЬКО КНОПКА ВОЗВРАТА. Рецепт встает на место сообщения ожидания
+            await show(callback.message, recipe, get_recipe_back_keyboard(), placeholder=wait)
             
         except Exception as e:
             logger.error(f"Dish error: {e}")
@@ -287,6 +518,13 @@ async def handle_callback(callback: CallbackQuery):
         return
 
 def register_handlers(dp: Dispatcher):
+    # Порядок важен: учет апдейтов для остановки, затем очередь пользователя, внутри нее — загрузка/сохранение сессии
+    dp.update.outer_middleware(update_tracker)
+    dp.update.outer_middleware(UserLaneMiddleware(is_input=is_products_update))
+    dp.update.outer_middleware(StateSyncMiddleware())
+    dp.message.middleware(HandlerMetricsMiddleware())
+    dp.callback_query.middleware(HandlerMetricsMiddleware())
+    
     dp.message.register(cmd_start, Command("start"))
     dp.message.register(cmd_author, Command("author"))
     dp.message.register(handle_direct_recipe, F.text.lower().startswith("дай рецепт"))
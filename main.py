@@ -2,11 +2,26 @@ import logging
 import sys
 import asyncio
 import os
+import secrets
+import signal
+import time
 from aiohttp import web
 from aiogram import Bot, Dispatcher
 from aiogram.types import BotCommand
-from config import TELEGRAM_TOKEN
-from handlers import register_handlers
+from config import TELEGRAM_TOKEN, WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_SECRET, UPDATE_QUEUE_SIZE, UPDATE_WORKERS
+from config import TG_CHAT_RPS, TG_CHAT_BURST, TG_GLOBAL_RPS, TG_GLOBAL_BURST, TG_MAX_RETRIES
+from config import SHUTDOWN_TIMEOUT, SNAPSHOT_PATH, WORKERS, WORKER_BASE_PORT, WORKER_INDEX
+from handlers import register_handlers, prefetcher
+from yandex_service import YandexService
+from classifier import classifier
+from catalog import catalog
+from state_manager import state_manager
+from webhook import WebhookIngress
+from supervisor import Supervisor
+from middlewares import TelegramMetricsMiddleware, FloodControlMiddleware, update_tracker
+from outbound import deleter
+import metrics
+import snapshot
 
 # Логирование
 logging.basicConfig(
@@ -18,6 +33,9 @@ logger = logging.getLogger(__name__)
 
 # Инициализация
 bot = Bot(token=TELEGRAM_TOKEN)
+# Сначала лимиты (ожидание в очереди), внутри — замер самого вызова
+bot.session.middleware(FloodControlMiddleware(TG_CHAT_RPS, TG_CHAT_BURST, TG_GLOBAL_RPS, TG_GLOBAL_BURST, TG_MAX_RETRIES))
+bot.session.middleware(TelegramMetricsMiddleware())
 dp = Dispatcher()
 register_handlers(dp)
 
@@ -26,19 +44,62 @@ async def health_check(request):
     """Простой эндпоинт, чтобы бот не засыпал"""
     return web.Response(text="Bot is alive!", status=200)
 
-async def start_web_server():
+# --- МЕТРИКИ ---
+scheduler_state = metrics.Gauge("yandex_scheduler", "YandexGPT scheduler state", ["field"])
+singleflight_state = metrics.Gauge("yandex_singleflight", "Coalesced GPT requests", ["field"])
+prefetch_state = metrics.Gauge("prefetch", "Dish list prefetch counters", ["field"])
+similar_hit_ratio = metrics.Gauge("similar_cache_hit_ratio", "Similarity cache hit ratio if the threshold were N", ["cache", "threshold"])
+outbound_state = metrics.Gauge("telegram_batched_deletes", "Messages removed via batched deleteMessages", ["field"])
+catalog_state = metrics.Gauge("recipe_catalog", "Menus served from the bundled recipe catalog", ["field"])
+classifier_state = metrics.Gauge("local_classifier", "Messages resolved by the local food lexicon vs sent to GPT", ["field"])
+
+def collect_runtime_metrics():
+    for name, stats in YandexService.cache_stats().items():
+        metrics.cache_items.set(stats["size"], cache=name)
+        metrics.cache_hit_ratio.set(stats["hit_ratio"], cache=name)
+        metrics.cache_requests.set(stats["hits"], cache=name, result="hit")
+        metrics.cache_requests.set(stats["misses"], cache=name, result="miss")
+        for threshold, ratio in stats.get("hit_ratio_at", {}).items():
+            similar_hit_ratio.set(ratio, cache=name, threshold=threshold)
+    metrics.sessions_active.set(state_manager.session_count())
+    metrics.sessions_memory.set(state_manager.memory_usage())
+    for field, value in YandexService.scheduler.stats().items():
+        scheduler_state.set(value, field=field)
+    for field, value in YandexService.flights.stats().items():
+        singleflight_state.set(value, field=field)
+    for field, value in prefetcher.stats().items():
+        prefetch_state.set(value, field=field)
+    for field, value in classifier.stats().items():
+        classifier_state.set(value, field=field)
+    for field, value in catalog.stats().items():
+        catalog_state.set(value, field=field)
+    for field, value in deleter.stats().items():
+        outbound_state.set(value, field=field)
+
+metrics.register_collector(collect_runtime_metrics)
+
+async def metrics_handler(request):
+    """Метрики в текстовом формате Prometheus"""
+    return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8")
+
+async def start_web_server(ingress: WebhookIngress = None):
     """Запуск веб-сервера на порту, который выдаст Render"""
     app = web.Application()
     app.router.add_get('/', health_check)
     app.router.add_get('/health', health_check)
+    app.router.add_get('/metrics', metrics_handler)
+    if ingress is not None:
+        app.router.add_post(WEBHOOK_PATH, ingress.handle)
     
     # Render передает порт через переменную окружения PORT
     # Если переменной нет (локальный запуск), используем 8080
     port = int(os.environ.get("PORT", 8080))
+    # Воркер принимает апдейты только от супервизора
+    host = "127.0.0.1" if WORKER_INDEX >= 0 else "0.0.0.0"
     
     runner = web.AppRunner(app)
     await runner.setup()
-    site = web.TCPSite(runner, "0.0.0.0", port)
+    site = web.TCPSite(runner, host, port)
     await site.start()
     logger.info(f"🌍 Web server started on port {port}")
 
@@ -53,20 +114,120 @@ async def setup_commands(bot: Bot):
     except Exception as e:
         logger.error(f"Failed to set commands: {e}")
 
+# --- ОСТАНОВКА ---
+def install_signal_handlers(stop: asyncio.Event):
+    """SIGTERM (рестарт контейнера) и SIGINT не обрывают цикл, а запускают плавную остановку."""
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:  # Windows
+            pass
+
+async def run_polling(stop: asyncio.Event):
+    # Сигналы ловим сами, а сессию бота закрываем после доработки хэндлеров
+    polling = asyncio.create_task(dp.start_polling(bot, handle_signals=False, close_bot_session=False))
+    stopped = asyncio.create_task(stop.wait())
+    await asyncio.wait([polling, stopped], return_when=asyncio.FIRST_COMPLETED)
+    stopped.cancel()
+    if not polling.done():
+        await dp.stop_polling()
+    await polling
+
 # --- ЗАПУСК ---
 async def main():
-    # 1. Запускаем веб-сервер (в фоне)
-    await start_web_server()
+    stop = asyncio.Event()
+    install_signal_handlers(stop)
+
+    # 1. Запускаем веб-сервер (в фоне). В режиме webhook он же принимает апдейты
+    ingress = None
+    if WEBHOOK_URL:
+        ingress = WebhookIngress(bot, dp, WEBHOOK_SECRET or secrets.token_urlsafe(32), UPDATE_QUEUE_SIZE, UPDATE_WORKERS)
+    await start_web_server(ingress)
+    
+    # 2. Открываем общий пул соединений к Yandex Cloud и запускаем чистку старых сессий
+    await YandexService.start()
+    catalog.open()
+    await state_manager.open()
+    state_manager.start_sweeper()
+    # Сессии и кеши прошлого запуска поднимаем в фоне: /health уже отвечает, апдейты уже принимаются
+    restoring = None
+    if SNAPSHOT_PATH:
+        restoring = asyncio.create_task(snapshot.restore(SNAPSHOT_PATH, state_manager, YandexService.caches()))
     
-    # 2. Устанавливаем команды
-    await setup_commands(bot)
+    # 3. Устанавливаем команды (в режиме воркеров это делает супервизор)
+    if WORKER_INDEX < 0:
+        await setup_commands(bot)
     
-    # 3. Запускаем поллинг бота (это блокирующий процесс, поэтому он последний)
-    logger.info("🚀 Bot started polling...")
-    await dp.start_polling(bot)
+    # 4. Получаем апдейты: webhook или поллинг (это блокирующий процесс, поэтому он последний)
+    try:
+        if WORKER_INDEX >= 0:
+            await ingress.start()
+            logger.info(f"🚀 Worker {WORKER_INDEX} started...")
+            await stop.wait()
+        elif ingress is not None:
+            await ingress.start()
+            await bot.set_webhook(
+                f"{WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}",
+                secret_token=ingress.secret,
+                allowed_updates=dp.resolve_used_update_types(),
+                max_connections=min(100, max(1, UPDATE_WORKERS * 2)),
+            )
+            logger.info("🚀 Bot started (webhook)...")
+            await stop.wait()
+        else:
+            logger.info("🚀 Bot started polling...")
+            await run_polling(stop)
+    finally:
+        # Новые апдейты уже не берем; текущие дорабатывают до дедлайна, потом отменяются
+        logger.info(f"🛑 Shutting down, draining {update_tracker.active()} updates (up to {SHUTDOWN_TIMEOUT:.0f}s)")
+        deadline = time.monotonic() + SHUTDOWN_TIMEOUT
+        if ingress is not None:
+            await ingress.stop(timeout=max(0.0, deadline - time.monotonic()))
+        await update_tracker.drain(deadline - time.monotonic())
+        await deleter.flush_all()
+        await state_manager.stop_sweeper()
+        if SNAPSHOT_PATH:
+            # Не успели дочитать старый снапшот — не затираем его неполным состоянием
+            if restoring is None or restoring.done():
+                snapshot.save(SNAPSHOT_PATH, state_manager, YandexService.caches())
+            else:
+                restoring.cancel()
+                logger.warning("Snapshot restore still running, previous snapshot kept")
+        await state_manager.close()
+        await YandexService.close()
+        catalog.close()
+        await bot.session.close()
+
+# --- РЕЖИМ НЕСКОЛЬКИХ ПРОЦЕССОВ ---
+async def supervise():
+    """Супервизор: принимает webhook и раздает апдейты WORKERS процессам по user_id."""
+    stop = asyncio.Event()
+    install_signal_handlers(stop)
+    supervisor = Supervisor(WORKERS, WORKER_BASE_PORT, WEBHOOK_SECRET or secrets.token_urlsafe(32))
+    await supervisor.start(int(os.environ.get("PORT", 8080)))
+    try:
+        await setup_commands(bot)
+        await bot.set_webhook(
+            f"{WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}",
+            secret_token=supervisor.secret,
+            allowed_updates=dp.resolve_used_update_types(),
+            max_connections=min(100, max(1, WORKERS * UPDATE_WORKERS * 2)),
+        )
+        logger.info(f"🚀 Bot started (webhook, {WORKERS} workers)...")
+        await stop.wait()
+    finally:
+        # Воркеры сами дорабатывают апдейты и пишут снапшоты; даем им запас сверх их дедлайна
+        await supervisor.stop(timeout=SHUTDOWN_TIMEOUT + 5)
+        await bot.session.close()
 
 if __name__ == "__main__":
+    if WORKERS > 1 and WORKER_INDEX < 0 and not WEBHOOK_URL:
+        logger.warning("WORKERS > 1 needs WEBHOOK_URL (one getUpdates consumer per bot), running a single process")
     try:
-        asyncio.run(main())
+        if WORKERS > 1 and WORKER_INDEX < 0 and WEBHOOK_URL:
+            asyncio.run(supervise())
+        else:
+            asyncio.run(main())
     except (KeyboardInterrupt, SystemExit):
         logger.info("Bot stopped")
\ No newline at end of file
@@ -0,0 +1,214 @@
+import functools
+import inspect
+import math
+import time
+from typing import Callable, Dict, List, Sequence, Tuple
+
+# Метрики в текстовом формате Prometheus, без внешних зависимостей
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 3, 5, 8, 13, 20, 30, 60)
+
+LabelValues = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _fmt_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _fmt_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help_text: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labels)
+        REGISTRY.append(self)
+
+    def _key(self, labels: Dict[str, str]) -> LabelValues:
+        return tuple(str(labels.get(n, "")) for n in self.labelnames)
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"] + self._samples()
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, labels: Sequence[str] = ()):
+        super().__init__(name, help_text, labels)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self) -> List[str]:
+        return [f"{self.name}{_fmt_labels(self.labelnames, k)} {_fmt_value(v)}" for k, v in self._values.items()]
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, name: str, help_text: str, labels: Sequence[str] = ()):
+        super().__init__(name, help_text, labels)
+        self._values: Dict[LabelValues, float] = {}
+
+    def set(self, value: float, **labels):
+        self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def _samples(self) -> List[str]:
+        return [f"{self.name}{_fmt_labels(self.labelnames, k)} {_fmt_value(v)}" for k, v in self._values.items()]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labels: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        # key -> [счетчики по бакетам..., сумма, количество]
+        self._values: Dict[LabelValues, List[float]] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        data = self._values.get(key)
+        if data is None:
+            data = self._values[key] = [0] * (len(self.buckets) + 2)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                data[i] += 1
+                break
+        data[-2] += value
+        data[-1] += 1
+
+    def quantile(self, q: float, **labels) -> float:
+        """Оценка квантиля по бакетам (верхняя граница бакета). 0 — если наблюдений нет."""
+        data = self._values.get(self._key(labels))
+        if not data or not data[-1]:
+            return 0.0
+        rank = q * data[-1]
+        cumulative = 0
+        for i, bound in enumerate(self.buckets):
+            cumulative += data[i]
+            if cumulative >= rank:
+                return bound
+        return self.buckets[-1]
+
+    def count(self, **labels) -> int:
+        data = self._values.get(self._key(labels))
+        return int(data[-1]) if data else 0
+
+    def _samples(self) -> List[str]:
+        lines = []
+        for key, data in self._values.items():
+            cumulative = 0
+            for i, bound in enumerate(self.buckets):
+                cumulative += data[i]
+                le = f'le="{_fmt_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_fmt_labels(self.labelnames, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_fmt_labels(self.labelnames, key)} {_fmt_value(data[-2])}")
+            lines.append(f"{self.name}_count{_fmt_labels(self.labelnames, key)} {int(data[-1])}")
+        return lines
+
+
+REGISTRY: List[_Metric] = []
+# Функции, которые обновляют gauge-метрики прямо перед отдачей (размеры кешей, число сессий...)
+COLLECTORS: List[Callable[[], None]] = []
+
+
+def register_collector(fn: Callable[[], None]):
+    COLLECTORS.append(fn)
+
+
+def render() -> str:
+    for collect in COLLECTORS:
+        collect()
+    lines: List[str] = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# --- ОБЩИЕ МЕТРИКИ БОТА ---
+yandex_latency = Histogram("yandex_request_seconds", "Latency of YandexService methods", ["method"])
+yandex_errors = Counter("yandex_errors_total", "Errors by YandexService method and reason", ["method", "reason"])
+yandex_in_flight = Gauge("yandex_in_flight", "YandexService calls in progress", ["method"])
+gpt_latency = Histogram("yandex_gpt_seconds", "Upstream GPT request latency by route", ["route"])
+gpt_hedges = Counter("yandex_gpt_hedges_total", "Backup GPT requests fired after the hedge deadline, by winner", ["route", "winner"])
+gpt_parse = Counter("yandex_gpt_parse_total", "Structured GPT answers by method and parse outcome", ["method", "outcome"])
+worker_up = Gauge("supervisor_worker_up", "Worker process answers /health", ["worker"])
+worker_restarts = Counter("supervisor_worker_restarts_total", "Worker processes respawned after exit", ["worker"])
+updates_routed = Counter("supervisor_updates_total", "Updates relayed from the ingress to workers", ["worker", "result"])
+handler_latency = Histogram("handler_seconds", "Telegram handler duration", ["handler"])
+handler_errors = Counter("handler_errors_total", "Unhandled exceptions in Telegram handlers", ["handler"])
+handlers_in_flight = Gauge("handlers_in_flight", "Telegram handlers in progress")
+updates_superseded = Counter("updates_superseded_total", "Handlers cancelled because the same user sent a newer update")
+telegram_latency = Histogram("telegram_api_seconds", "Bot API call duration", ["method"])
+telegram_flood_waits = Counter("telegram_flood_waits_total", "Bot API 429 responses (retry_after honoured)", ["method"])
+telegram_throttle_seconds = Counter("telegram_throttle_seconds_total", "Time Bot API calls waited for outbound rate limits")
+cache_items = Gauge("cache_items", "Entries in response cache", ["cache"])
+cache_hit_ratio = Gauge("cache_hit_ratio", "Response cache hit ratio", ["cache"])
+cache_requests = Gauge("cache_requests", "Response cache lookups by result", ["cache", "result"])
+sessions_active = Gauge("sessions_active", "User sessions held in memory")
+sessions_memory = Gauge("sessions_memory_bytes", "Approximate memory used by sessions")
+
+
+def instrumented(method: str):
+    """Декоратор для методов YandexService: время, ошибки и число вызовов в полете.
+
+    Для async-генераторов (потоковые методы) время считается до последнего чанка.
+    """
+    def decorator(fn):
+        if inspect.isasyncgenfunction(fn):
+            @functools.wraps(fn)
+            async def gen_wrapper(*args, **kwargs):
+                start = time.monotonic()
+                yandex_in_flight.inc(method=method)
+                try:
+                    async for item in fn(*args, **kwargs):
+                        yield item
+                except Exception as e:
+                    yandex_errors.inc(method=method, reason=type(e).__name__)
+                    raise
+                finally:
+                    yandex_in_flight.dec(method=method)
+                    yandex_latency.observe(time.monotonic() - start, method=method)
+            return gen_wrapper
+
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            start = time.monotonic()
+            yandex_in_flight.inc(method=method)
+            try:
+                return await fn(*args, **kwargs)
+            except Exception as e:
+                yandex_errors.inc(method=method, reason=type(e).__name__)
+                raise
+            finally:
+                yandex_in_flight.dec(method=method)
+                yandex_latency.observe(time.monotonic() - start, method=method)
+        return wrapper
+    return decorator
@@ -0,0 +1,318 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Optional, Set
+from aiogram import BaseMiddleware, Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import TelegramMethod
+from aiogram.methods.base import TelegramType
+from aiogram.types import TelegramObject, Update
+from metrics import handler_latency, handler_errors, handlers_in_flight, telegram_latency, updates_superseded
+from metrics import telegram_flood_waits, telegram_throttle_seconds
+from scheduler import TokenBucket
+from state_manager import state_manager
+
+logger = logging.getLogger(__name__)
+
+
+class _Lane:
+    """Очередь апдейтов одного пользователя."""
+    __slots__ = ("lock", "task", "key", "keys", "users", "inputs", "latest", "interruptible")
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.task: Optional[asyncio.Task] = None  # Хэндлер, который сейчас работает
+        self.key = ""                             # Что он обрабатывает (текст или callback_data)
+        self.keys: Set[str] = set()               # Ключи апдейтов в работе и в очереди
+        self.users = 0                            # Апдейтов в работе и в очереди
+        self.inputs = 0                           # Из них сообщений с продуктами
+        self.latest = 0                           # Номер последнего пришедшего апдейта
+        self.interruptible = False                # Хэндлер сейчас можно прервать новым сообщением с продуктами
+
+
+class UpdateTracker(BaseMiddleware):
+    """Учет апдейтов в работе — чтобы при остановке дождаться их, а не обрывать на полуслове."""
+
+    def __init__(self):
+        self._tasks: Set[asyncio.Task] = set()
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        task = asyncio.current_task()
+        self._tasks.add(task)
+        self._idle.clear()
+        try:
+            return await handler(event, data)
+        finally:
+            self._tasks.discard(task)
+            if not self._tasks:
+                self._idle.set()
+
+    async def drain(self, timeout: float) -> int:
+        """Ждет доработки апдейтов не дольше timeout, оставшиеся отменяет. Возвращает число отмененных."""
+        try:
+            await asyncio.wait_for(self._idle.wait(), max(0.0, timeout))
+        except asyncio.TimeoutError:
+            pass
+        left = [t for t in self._tasks if not t.done()]
+        for task in left:
+            task.cancel()
+        if left:
+            logger.warning(f"Shutdown deadline reached, cancelled updates: {len(left)}")
+        return len(left)
+
+    def active(self) -> int:
+        return len(self._tasks)
+
+
+update_tracker = UpdateTracker()
+
+
+class UserLaneMiddleware(BaseMiddleware):
+    """Апдейты одного пользователя обрабатываются строго по очереди.
+
+    Новое действие отменяет еще работающий хэндлер нажатия кнопки (а нажатия, еще стоящие
+    в очереди, пропускаются): их ответ уже устарел. Отмена доходит до YandexService — single-flight
+    отпускает запрос к GPT, если его больше никто не ждет.
+    Хэндлер сообщения кнопкой не отменяется никогда — иначе потеряются продукты; новым сообщением —
+    только пока он сам пометил себя interruptible (текст уже в буфере склейки; lane передается ему
+    как user_lane). Повтор апдейта, который уже в работе или в очереди (двойной тап), отбрасывается
+    сразу, не занимая воркер ожиданием очереди. Регистрируется раньше StateSyncMiddleware,
+    чтобы загрузка и сохранение сессии тоже шли по очереди.
+    """
+
+    # Служебные кнопки, которые не должны прерывать генерацию
+    PASSTHROUGH = {"delete_msg"}
+
+    def __init__(self, is_input: Optional[Callable[[Update], bool]] = None):
+        self._lanes: Dict[int, _Lane] = {}
+        # Апдейт, который заберет накопленный ввод (сообщение с продуктами): только он прерывает ожидание
+        self._is_input = is_input or (lambda update: False)
+
+    @staticmethod
+    def _key(event: TelegramObject) -> str:
+        if isinstance(event, Update):
+            if event.callback_query is not None:
+                return f"cb:{event.callback_query.data}"
+            if event.message is not None:
+                # Два разных голосовых — разные апдейты, а не повтор
+                return f"msg:{event.message.text or f'{event.message.content_type}:{event.message.message_id}'}"
+        return ""
+
+    @staticmethod
+    async def _answer_skipped(event: TelegramObject):
+        """Пропущенное нажатие все равно подтверждаем, иначе на кнопке крутятся часики."""
+        if isinstance(event, Update) and event.callback_query is not None:
+            try:
+                await event.callback_query.answer()
+            except Exception as e:
+                logger.debug(f"Skipped callback not answered: {e}")
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        user = data.get("event_from_user")
+        key = self._key(event)
+        if user is None or key[3:] in self.PASSTHROUGH:
+            return await handler(event, data)
+
+        lane = self._lanes.get(user.id)
+        if lane is None:
+            lane = self._lanes[user.id] = _Lane()
+        if key in lane.keys:
+            updates_superseded.inc()
+            await self._answer_skipped(event)
+            return None
+        is_input = isinstance(event, Update) and self._is_input(event)
+        lane.keys.add(key)
+        lane.users += 1
+        lane.inputs += is_input
+        lane.latest += 1
+        seq = lane.latest
+        # Время прихода, а не начала обработки: апдейт мог простоять в очереди
+        data["arrived_at"] = time.monotonic()
+        try:
+            if self._supersedes(lane, key, is_input):
+                lane.task.cancel()
+                updates_superseded.inc()
+            async with lane.lock:
+                if seq != lane.latest and key.startswith("cb:"):
+                    # Пока ждали очереди, пользователь уже сделал что-то новое
+                    updates_superseded.inc()
+                    await self._answer_skipped(event)
+                    return None
+                data["user_lane"] = lane
+                task = asyncio.create_task(handler(event, data))
+                lane.task, lane.key, lane.interruptible = task, key, False
+                try:
+                    return await task
+                except asyncio.CancelledError:
+                    # Отменили нас снаружи (остановка бота) — пробрасываем; вытеснил новый апдейт — тихо выходим
+                    if asyncio.current_task().cancelling() or not task.cancelled():
+                        raise
+                    logger.info(f"Update superseded for user {user.id}: {key}")
+                    await self._answer_skipped(event)
+                    return None
+                finally:
+                    if lane.task is task:
+                        lane.task = None
+        finally:
+            lane.keys.discard(key)
+            lane.users -= 1
+            lane.inputs -= is_input
+            if lane.users == 0 and self._lanes.get(user.id) is lane:
+                del self._lanes[user.id]
+
+    @staticmethod
+    def _supersedes(lane: _Lane, key: str, is_input: bool) -> bool:
+        if lane.task is None or lane.task.done() or lane.key == key:
+            return False
+        if lane.key.startswith("msg:"):
+            # Сообщение с продуктами прерывает только следующее сообщение с продуктами — оно заберет
+            # и накопленный текст. Кнопка, стикер или "дай рецепт" подождут своей очереди
+            return lane.interruptible and is_input
+        return True
+
+    def active(self) -> int:
+        return len(self._lanes)
+
+
+class StateSyncMiddleware(BaseMiddleware):
+    """Перед апдейтом подтягивает сессию пользователя из хранилища, после — сохраняет.
+
+    С общим хранилищем (SQLite) это позволяет нескольким процессам обслуживать
+    одного пользователя: callback dish_N может прийти в другой процесс.
+    """
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        user = data.get("event_from_user")
+        if user is None:
+            return await handler(event, data)
+        await state_manager.load(user.id)
+        try:
+            return await handler(event, data)
+        finally:
+            await state_manager.commit(user.id)
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Время работы и ошибки каждого хэндлера (по имени функции)."""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        handler_object = data.get("handler")
+        name = handler_object.callback.__name__ if handler_object is not None else "unknown"
+        start = time.monotonic()
+        handlers_in_flight.inc()
+        try:
+            return await handler(event, data)
+        except Exception:
+            handler_errors.inc(handler=name)
+            raise
+        finally:
+            handlers_in_flight.dec()
+            handler_latency.observe(time.monotonic() - start, handler=name)
+
+
+class TelegramMetricsMiddleware(BaseRequestMiddleware):
+    """Время вызовов Bot API (sendMessage, editMessageText...)."""
+
+    async def __call__(
+        self,
+        make_request: NextRequestMiddlewareType[TelegramType],
+        bot: Bot,
+        method: TelegramMethod[TelegramType],
+    ):
+        start = time.monotonic()
+        try:
+            return await make_request(bot, method)
+        finally:
+            telegram_latency.observe(time.monotonic() - start, method=method.__api_method__)
+
+
+class FloodControlMiddleware(BaseRequestMiddleware):
+    """Лимиты Bot API на исходящие: токен-бакет на каждый чат и общий на бота.
+
+    Если Telegram все же ответил 429, ждем retry_after и повторяем; пока ждем, остальные
+    запросы в этот чат тоже придерживаются.
+    Регистрируется первым, чтобы TelegramMetricsMiddleware мерил только сам вызов.
+    """
+
+    MAX_CHATS = 10000  # Бакетов чатов в памяти (LRU)
+
+    def __init__(self, chat_rps: float, chat_burst: float, global_rps: float, global_burst: float, max_retries: int):
+        self.chat_rps = chat_rps
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.global_bucket = TokenBucket(global_rps, global_burst)
+        self._chats: "OrderedDict[Any, TokenBucket]" = OrderedDict()
+        self._paused_until: Dict[Any, float] = {}  # chat_id -> monotonic, до которого чат на паузе после 429
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rps, self.chat_burst)
+            while len(self._chats) > self.MAX_CHATS:
+                self._chats.popitem(last=False)
+        else:
+            self._chats.move_to_end(chat_id)
+        return bucket
+
+    async def _wait_pause(self, chat_id):
+        while True:
+            until = self._paused_until.get(chat_id)
+            if until is None:
+                return
+            now = time.monotonic()
+            if until <= now:
+                self._paused_until.pop(chat_id, None)
+                return
+            await asyncio.sleep(until - now)
+
+    async def __call__(
+        self,
+        make_request: NextRequestMiddlewareType[TelegramType],
+        bot: Bot,
+        method: TelegramMethod[TelegramType],
+    ):
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None:
+            # answerCallbackQuery, getFile, setWebhook... — не сообщения в чат
+            return await make_request(bot, method)
+
+        attempt = 0
+        while True:
+            start = time.monotonic()
+            await self._wait_pause(chat_id)
+            await self._chat_bucket(chat_id).acquire()
+            await self.global_bucket.acquire()
+            telegram_throttle_seconds.inc(time.monotonic() - start)
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                telegram_flood_waits.inc(method=method.__api_method__)
+                attempt += 1
+                if attempt > self.max_retries:
+                    raise
+                logger.warning(f"Flood control: {method.__api_method__} to {chat_id}, retry after {e.retry_after}s")
+                self._paused_until[chat_id] = max(self._paused_until.get(chat_id, 0), time.monotonic() + e.retry_after)
@@ -0,0 +1,83 @@
+import asyncio
+import logging
+from typing import Dict, List, Optional
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import InlineKeyboardMarkup, Message
+from config import TG_DELETE_DELAY
+
+logger = logging.getLogger(__name__)
+
+# Исходящие сообщения: правка вместо "удалить + отправить" и пакетные удаления
+
+
+class DeleteBatcher:
+    """Копит удаления по чатам и отправляет их одним deleteMessages (до 100 id за вызов)."""
+
+    BATCH = 100
+
+    def __init__(self, delay: float):
+        self.delay = delay
+        self._pending: Dict[int, List[int]] = {}
+        self._bots: Dict[int, Bot] = {}
+        self._tasks: Dict[int, asyncio.Task] = {}
+        self.deleted = 0  # Сообщений удалено
+        self.calls = 0    # Вызовов Bot API на это ушло
+
+    def delete(self, message: Message):
+        self.delete_ids(message.bot, message.chat.id, [message.message_id])
+
+    def delete_ids(self, bot: Bot, chat_id: int, message_ids: List[int]):
+        self._pending.setdefault(chat_id, []).extend(message_ids)
+        self._bots[chat_id] = bot
+        if chat_id not in self._tasks:
+            self._tasks[chat_id] = asyncio.create_task(self._flush_later(chat_id))
+
+    async def _flush_later(self, chat_id: int):
+        await asyncio.sleep(self.delay)
+        self._tasks.pop(chat_id, None)
+        await self._flush(chat_id)
+
+    async def _flush(self, chat_id: int):
+        ids = self._pending.pop(chat_id, [])
+        bot = self._bots.pop(chat_id, None)
+        for i in range(0, len(ids), self.BATCH):
+            chunk = ids[i:i + self.BATCH]
+            self.calls += 1
+            try:
+                await bot.delete_messages(chat_id=chat_id, message_ids=chunk)
+                self.deleted += len(chunk)
+            except Exception as e:
+                logger.warning(f"Batch delete failed in {chat_id}: {e}")
+
+    async def flush_all(self):
+        """Отправляет все отложенные удаления сразу (остановка бота)."""
+        for task in list(self._tasks.values()):
+            task.cancel()
+        self._tasks.clear()
+        for chat_id in list(self._pending):
+            await self._flush(chat_id)
+
+    def stats(self) -> Dict[str, int]:
+        return {"deleted": self.deleted, "calls": self.calls, "pending": sum(len(v) for v in self._pending.values())}
+
+
+deleter = DeleteBatcher(TG_DELETE_DELAY)
+
+
+async def show(message: Message, text: str, reply_markup: Optional[InlineKeyboardMarkup] = None,
+               placeholder: Optional[Message] = None) -> Message:
+    """Показывает text правкой placeholder (один editMessageText вместо удаления и новой отправки).
+
+    Без placeholder или если править нельзя — отправляет новое сообщение, а placeholder удаляет пакетом.
+    """
+    if placeholder is not None:
+        try:
+            edited = await placeholder.edit_text(text, reply_markup=reply_markup, parse_mode="HTML")
+            return edited if isinstance(edited, Message) else placeholder
+        except TelegramBadRequest as e:
+            if "not modified" in str(e):
+                return placeholder
+            logger.warning(f"Edit failed, sending new message: {e}")
+            deleter.delete(placeholder)
+    return await message.answer(text, reply_markup=reply_markup, parse_mode="HTML")
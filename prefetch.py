@@ -0,0 +1,104 @@
+import asyncio
+import logging
+from typing import Dict, List, Optional, Set, Tuple
+from products import products_key
+from scheduler import Priority, current_priority
+from yandex_service import YandexService
+
+logger = logging.getLogger(__name__)
+
+
+class DishPrefetcher:
+    """Спекулятивно генерирует списки блюд для всех категорий, пока пользователь выбирает.
+
+    Результаты попадают в кеш YandexService, а нажатие cat_ дожидается уже идущего запроса
+    вместо нового. Брошенные предзагрузки (новые продукты, рестарт) отменяются.
+    Здесь хранятся только незавершенные задачи: готовое уже лежит в кеше.
+    """
+
+    def __init__(self, concurrency: int):
+        self._sem = asyncio.Semaphore(concurrency)
+        # user_id -> category -> (ключ продуктов+стиль, задача)
+        self._tasks: Dict[int, Dict[str, Tuple[str, asyncio.Task]]] = {}
+        self._running: Set[asyncio.Task] = set()  # Задачи, которые уже прошли семафор и ждут GPT
+        self.started = 0
+        self.used = 0
+        self.cancelled = 0
+
+    @staticmethod
+    def _key(products: str, style: str) -> str:
+        return f"{products_key(products)}|{style}"
+
+    async def _fetch(self, products: str, category: str, style: str) -> List[dict]:
+        # Предзагрузка — фоновая работа: пропускает вперед запросы, которых пользователь ждет
+        current_priority.set(Priority.BACKGROUND)
+        async with self._sem:
+            task = asyncio.current_task()
+            self._running.add(task)
+            try:
+                return await YandexService.generate_dishes_list(products, category, style)
+            finally:
+                self._running.discard(task)
+
+    def start(self, user_id: int, products: str, categories: List[str], style: str):
+        self.cancel(user_id)
+        key = self._key(products, style)
+        tasks = {}
+        for category in categories:
+            task = asyncio.create_task(self._fetch(products, category, style))
+            task.add_done_callback(lambda t, c=category: self._on_done(user_id, c, t))
+            tasks[category] = (key, task)
+        if tasks:
+            self._tasks[user_id] = tasks
+        self.started += len(tasks)
+
+    async def take(self, user_id: int, products: str, category: str, style: str) -> Optional[List[dict]]:
+        """Результат предзагрузки для категории (дожидается, если она уже идет).
+
+        None — предзагрузки нет, она еще стоит в очереди или ничего не дала ([] — так
+        generate_dishes_list отвечает на любую ошибку): тогда вызывающий спрашивает GPT сам,
+        с обычным приоритетом, а не ждет фоновую задачу.
+        """
+        entry = self._tasks.get(user_id, {}).get(category)
+        if entry is None or entry[0] != self._key(products, style):
+            return None
+        task = entry[1]
+        if not task.done() and task not in self._running:
+            task.cancel()
+            self.cancelled += 1
+            return None
+        try:
+            # shield: если отменят ожидающий хэндлер, сама предзагрузка доживет до кеша
+            result = await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if task.cancelled():
+                return None
+            raise
+        except Exception:
+            return None
+        if not result:
+            return None
+        self.used += 1
+        return result
+
+    def cancel(self, user_id: int):
+        tasks = self._tasks.pop(user_id, None)
+        if not tasks:
+            return
+        for _, task in tasks.values():
+            if not task.done():
+                task.cancel()
+                self.cancelled += 1
+
+    def _on_done(self, user_id: int, category: str, task: asyncio.Task):
+        tasks = self._tasks.get(user_id)
+        if tasks and tasks.get(category, (None, None))[1] is task:
+            del tasks[category]
+            if not tasks:
+                del self._tasks[user_id]
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Prefetch error: {task.exception()}")
+
+    def stats(self) -> Dict[str, int]:
+        in_flight = sum(len(tasks) for tasks in self._tasks.values())
+        return {"started": self.started, "used": self.used, "cancelled": self.cancelled, "in_flight": in_flight}
@@ -0,0 +1,107 @@
+import re
+from typing import Dict, Iterable, List, Optional
+from config import MAX_PRODUCTS
+
+# Окончания, которые срезаем при сворачивании словоформ (длинные проверяются первыми)
+_ENDINGS = sorted([
+    "ями", "ами", "ого", "его", "ому", "ему",
+    "ах", "ях", "ов", "ев", "ей", "ой", "ый", "ий", "ая", "яя", "ое", "ее", "ые", "ие", "ом", "ем", "ам", "ям", "ую", "юю",
+    "а", "я", "о", "е", "ы", "и", "у", "ю", "ь", "й",
+], key=len, reverse=True)
+_MIN_STEM = 3
+
+_SPLIT_RE = re.compile(r"[,;\n]+|\s+и\s+|\s+\+\s+")
+_JUNK_RE = re.compile(r"[^\w\s-]+")
+_SPACES_RE = re.compile(r"\s+")
+
+
+def stem(word: str) -> str:
+    """Грубое сворачивание русской словоформы: морковь/морковка/моркови -> морков."""
+    word = word.replace("ё", "е")
+    for ending in _ENDINGS:
+        if word.endswith(ending) and len(word) - len(ending) >= _MIN_STEM:
+            word = word[:-len(ending)]
+            break
+    # Уменьшительный суффикс: картошка -> картош, морковка -> морков
+    for suffix in ("ок", "ек", "к"):
+        if word.endswith(suffix) and len(word) - len(suffix) >= 4:
+            word = word[:-len(suffix)]
+            break
+    return word
+
+
+def clean(item: str) -> str:
+    """Нижний регистр, без пунктуации и лишних пробелов."""
+    item = _JUNK_RE.sub(" ", item.lower())
+    return _SPACES_RE.sub(" ", item).strip(" -")
+
+
+def fold(item: str) -> str:
+    """Ключ одного продукта: каждое слово сведено к основе."""
+    return " ".join(stem(w) for w in item.split())
+
+
+def split_products(text: str) -> List[str]:
+    """Разбивает сырой текст пользователя на очищенные названия продуктов."""
+    items = (clean(part) for part in _SPLIT_RE.split(text))
+    return [i for i in items if i]
+
+
+class ProductSet:
+    """Дедуплицированный набор продуктов пользователя.
+
+    Хранит первую встреченную форму для показа, а сравнивает по свернутому ключу,
+    поэтому "Морковь" и "морковка" считаются одним продуктом.
+    """
+
+    __slots__ = ("_items",)
+
+    def __init__(self, items: Optional[Iterable[str]] = None):
+        self._items: Dict[str, str] = {}  # fold -> отображаемое название (порядок добавления)
+        if items:
+            self.extend(items)
+
+    @classmethod
+    def from_text(cls, text: str) -> "ProductSet":
+        return cls(split_products(text))
+
+    def extend(self, items: Iterable[str]) -> List[str]:
+        """Добавляет продукты, возвращает реально новые."""
+        added = []
+        for item in items:
+            item = clean(item)
+            if not item:
+                continue
+            key = fold(item)
+            if key in self._items:
+                continue
+            self._items[key] = item
+            added.append(item)
+        # Лимит: при переполнении забываем самые старые продукты
+        while len(self._items) > MAX_PRODUCTS:
+            del self._items[next(iter(self._items))]
+        return added
+
+    def add_text(self, text: str) -> List[str]:
+        return self.extend(split_products(text))
+
+    def items(self) -> List[str]:
+        return list(self._items.values())
+
+    def key(self) -> str:
+        """Стабильный ключ, не зависящий от порядка и словоформ. Годится для хеширования."""
+        return ",".join(sorted(self._items))
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def __bool__(self) -> bool:
+        return bool(self._items)
+
+    def __str__(self) -> str:
+        return ", ".join(self._items.values())
+
+
+def products_key(text: str) -> str:
+    """Ключ набора продуктов прямо из сырого текста."""
+    return ProductSet.from_text(text).key()
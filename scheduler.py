@@ -0,0 +1,166 @@
+import asyncio
+import contextvars
+import logging
+import random
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from enum import IntEnum
+from typing import Awaitable, Callable, Deque, Dict, Optional, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class Priority(IntEnum):
+    """Полосы приоритета: чем меньше значение, тем раньше запрос получает слот."""
+    INTERACTIVE = 0  # Рецепт, который пользователь ждет прямо сейчас
+    NORMAL = 1       # Обычные шаги диалога
+    BACKGROUND = 2   # Спекулятивная и фоновая работа (предзагрузка)
+
+
+# Приоритет по умолчанию для запросов из текущей задачи (фоновые задачи ставят BACKGROUND)
+current_priority: contextvars.ContextVar[Priority] = contextvars.ContextVar("current_priority", default=Priority.NORMAL)
+
+
+class SchedulerBusy(Exception):
+    """Очередь полосы переполнена — запрос отклонен сразу, без ожидания."""
+
+
+class RetryableError(Exception):
+    """Временная ошибка апстрима (429, 5xx, таймаут): запрос можно повторить."""
+
+    def __init__(self, message: str, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """Ограничение частоты: rate запросов в секунду, всплеск до burst."""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        if self.rate <= 0:
+            return
+        while True:
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class ApiScheduler:
+    """Единая точка выхода к API: лимит RPS, лимит параллельности, приоритеты и повторы с backoff."""
+
+    def __init__(self, rps: float, burst: float, concurrency: int, lane_limits: Dict[Priority, int],
+                 max_retries: int, backoff_base: float, backoff_max: float):
+        self.bucket = TokenBucket(rps, burst)
+        self.concurrency = concurrency
+        self.lane_limits = lane_limits
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._active = 0
+        self._lanes: Dict[Priority, Deque[asyncio.Future]] = {p: deque() for p in Priority}
+        self.rejected = 0
+        self.retries = 0
+        self.failures = 0
+
+    # --- СЛОТЫ ---
+    def _queued(self) -> int:
+        return sum(len(lane) for lane in self._lanes.values())
+
+    async def _acquire(self, priority: Priority):
+        if self._active < self.concurrency and not self._queued():
+            self._active += 1
+            return
+        lane = self._lanes[priority]
+        if len(lane) >= self.lane_limits.get(priority, 0):
+            self.rejected += 1
+            raise SchedulerBusy(f"{priority.name} lane is full")
+        waiter = asyncio.get_running_loop().create_future()
+        lane.append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # Слот уже был отдан нам — возвращаем его следующему
+                self._release()
+            elif waiter in lane:
+                lane.remove(waiter)
+            raise
+
+    def _release(self):
+        self._active -= 1
+        for priority in Priority:
+            lane = self._lanes[priority]
+            while lane:
+                waiter = lane.popleft()
+                if not waiter.done():
+                    self._active += 1
+                    waiter.set_result(None)
+                    return
+
+    @asynccontextmanager
+    async def slot(self, priority: Optional[Priority] = None):
+        """Занимает слот параллельности (по приоритету) и токен частоты."""
+        await self._acquire(priority if priority is not None else current_priority.get())
+        try:
+            await self.bucket.acquire()
+            yield
+        finally:
+            self._release()
+
+    # --- ПОВТОРЫ ---
+    def backoff_delay(self, attempt: int, retry_after: Optional[float] = None) -> float:
+        """Экспоненциальная задержка с полным джиттером; Retry-After апстрима — нижняя граница."""
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+        return max(delay, retry_after or 0)
+
+    async def sleep_backoff(self, attempt: int, error: RetryableError):
+        """Пауза перед повтором номер attempt+1 (вызывать вне слота)."""
+        delay = self.backoff_delay(attempt, error.retry_after)
+        self.retries += 1
+        logger.warning(f"Retry {attempt + 1}/{self.max_retries} in {delay:.1f}s: {error}")
+        await asyncio.sleep(delay)
+
+    async def run(self, call: Callable[[], Awaitable[T]], priority: Optional[Priority] = None) -> T:
+        """Выполняет call() через планировщик, повторяя при RetryableError."""
+        priority = priority if priority is not None else current_priority.get()
+        attempt = 0
+        while True:
+            try:
+                async with self.slot(priority):
+                    return await call()
+            except RetryableError as e:
+                if attempt >= self.max_retries:
+                    self.failures += 1
+                    raise
+                # Ждем вне слота, чтобы не держать место для остальных
+                await self.sleep_backoff(attempt, e)
+                attempt += 1
+
+    def has_capacity(self) -> bool:
+        """Есть свободный слот и никто не ждет — дополнительный запрос никого не задержит."""
+        return self._active < self.concurrency and not self._queued()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "active": self._active,
+            "queued": self._queued(),
+            "rejected": self.rejected,
+            "retries": self.retries,
+            "failures": self.failures,
+        }
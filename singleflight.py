@@ -0,0 +1,114 @@
+import asyncio
+import logging
+from typing import AsyncIterator, Awaitable, Callable, Dict, Optional, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class _Flight:
+    """Один запрос в полете и все, кто ждет его результат."""
+    __slots__ = ("task", "waiters", "value", "version", "done", "changed")
+
+    def __init__(self):
+        self.task: Optional[asyncio.Task] = None
+        self.waiters = 0
+        # Для потоков: последнее (накопленное) значение и его номер
+        self.value = None
+        self.version = 0
+        self.done = False
+        self.changed = asyncio.Event()
+
+
+class SingleFlight:
+    """Склеивает одновременные одинаковые запросы в один апстрим-запрос.
+
+    Отмена одного ожидающего не трогает остальных; сам запрос отменяется,
+    только когда его не ждет уже никто.
+    """
+
+    def __init__(self):
+        self._calls: Dict[str, _Flight] = {}
+        self._streams: Dict[str, _Flight] = {}
+        self.leaders = 0        # Реально отправленные запросы
+        self.deduplicated = 0   # Вызовы, присоединившиеся к уже идущему запросу
+
+    def _join(self, flights: Dict[str, _Flight], key: str, start: Callable[[_Flight], Awaitable]) -> _Flight:
+        flight = flights.get(key)
+        if flight is None:
+            flight = _Flight()
+            flight.task = asyncio.create_task(start(flight))
+            flight.task.add_done_callback(lambda t: self._finish(flights, key, flight, t))
+            flights[key] = flight
+            self.leaders += 1
+        else:
+            self.deduplicated += 1
+        flight.waiters += 1
+        return flight
+
+    @staticmethod
+    def _finish(flights: Dict[str, _Flight], key: str, flight: _Flight, task: asyncio.Task):
+        if flights.get(key) is flight:
+            del flights[key]
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Single-flight call failed: {task.exception()}")
+
+    @staticmethod
+    def _leave(flights: Dict[str, _Flight], key: str, flight: _Flight):
+        flight.waiters -= 1
+        if flight.waiters == 0 and not flight.task.done():
+            # Результат больше никому не нужен — освобождаем апстрим. Ключ убираем сразу:
+            # новый вызов не должен присоединиться к отменяемому запросу и получить CancelledError
+            flight.task.cancel()
+            if flights.get(key) is flight:
+                del flights[key]
+
+    async def do(self, key: str, call: Callable[[], Awaitable[T]]) -> T:
+        """Выполняет call() или присоединяется к идущему вызову с тем же ключом."""
+        async def start(flight: _Flight):
+            return await call()
+
+        flight = self._join(self._calls, key, start)
+        try:
+            return await asyncio.shield(flight.task)
+        finally:
+            self._leave(self._calls, key, flight)
+
+    async def stream(self, key: str, factory: Callable[[], AsyncIterator[T]]) -> AsyncIterator[T]:
+        """Потоковый вариант do(): все подписчики видят значения одного генератора.
+
+        Рассчитан на накопительные потоки (каждое значение — весь текст на данный момент),
+        поэтому опоздавший подписчик сразу получает последнее значение.
+        """
+        async def start(flight: _Flight):
+            try:
+                async for value in factory():
+                    flight.value = value
+                    flight.version += 1
+                    flight.changed.set()
+            finally:
+                flight.done = True
+                flight.changed.set()
+
+        flight = self._join(self._streams, key, start)
+        seen = 0
+        try:
+            while True:
+                if flight.version > seen:
+                    seen = flight.version
+                    yield flight.value
+                elif flight.done:
+                    return
+                else:
+                    flight.changed.clear()
+                    await flight.changed.wait()
+        finally:
+            self._leave(self._streams, key, flight)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "leaders": self.leaders,
+            "deduplicated": self.deduplicated,
+            "in_flight": len(self._calls) + len(self._streams),
+        }
@@ -0,0 +1,75 @@
+"""Снапшот сессий и кешей ответов между рестартами (деплой на Render = SIGTERM и новый контейнер).
+
+Пишется при остановке, читается в фоне уже после старта веб-сервера: /health отвечает сразу,
+а сессии и кеши доезжают следом. Формат — zlib(pickle), файл пишется атомарно; читает его
+только сам бот.
+"""
+import asyncio
+import logging
+import os
+import pickle
+import time
+import zlib
+from typing import Iterable, Optional
+from cache import TTLCache
+from state_manager import StateManager
+
+logger = logging.getLogger(__name__)
+
+FORMAT = 1
+
+
+def save(path: str, sessions: StateManager, caches: Iterable[TTLCache]) -> bool:
+    """Пишет снапшот. Сессии из общего хранилища (sqlite) и так переживут рестарт — их не пишем."""
+    payload = {
+        "format": FORMAT,
+        "saved_at": time.time(),
+        "sessions": [] if sessions.backend.shared else sessions.dump(),
+        "caches": {c.name: c.dump() for c in caches},
+    }
+    tmp = f"{path}.tmp"
+    try:
+        raw = zlib.compress(pickle.dumps(payload, protocol=pickle.HIGHEST_PROTOCOL), 6)
+        with open(tmp, "wb") as f:
+            f.write(raw)
+        os.replace(tmp, path)
+    except Exception as e:
+        logger.error(f"Snapshot save error: {e}")
+        return False
+    entries = sum(len(v) for v in payload["caches"].values())
+    logger.info(f"💾 Snapshot saved: {len(payload['sessions'])} sessions, {entries} cache entries, "
+                f"{len(raw) // 1024} KiB -> {path}")
+    return True
+
+
+def read(path: str) -> Optional[dict]:
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as f:
+        payload = pickle.loads(zlib.decompress(f.read()))
+    if not isinstance(payload, dict) or payload.get("format") != FORMAT:
+        logger.warning(f"Snapshot {path}: unsupported format, ignored")
+        return None
+    return payload
+
+
+async def restore(path: str, sessions: StateManager, caches: Iterable[TTLCache]):
+    """Фоновая загрузка: чтение и распаковка в отдельном потоке, слияние — в цикле событий.
+
+    То, что пользователи успели создать до конца загрузки, свежее снапшота и не перезаписывается.
+    """
+    start = time.monotonic()
+    try:
+        payload = await asyncio.to_thread(read, path)
+    except Exception as e:
+        logger.error(f"Snapshot load error: {e}")
+        return
+    if payload is None:
+        return
+    restored = sessions.restore(payload.get("sessions", []), max(0.0, time.time() - payload["saved_at"]))
+    entries = 0
+    for cache in caches:
+        entries += cache.restore(payload["caches"].get(cache.name, []))
+        await asyncio.sleep(0)
+    logger.info(f"💾 Snapshot loaded: {restored} sessions, {entries} cache entries "
+                f"in {time.monotonic() - start:.2f}s")
@@ -1,26 +1,237 @@
-from config import MAX_HISTORY_MESSAGES
+import asyncio
+import json
+import logging
+import random
+import sys
+import time
+from collections import OrderedDict
+from config import MAX_HISTORY_MESSAGES, SESSION_TTL, MAX_SESSIONS, SESSION_SWEEP_INTERVAL, STATE_BACKEND, STATE_DB_PATH
 from typing import Dict, List, Optional
+from products import ProductSet
+from storage import StateBackend, create_backend
+
+logger = logging.getLogger(__name__)
+
+MEMORY_SAMPLE = 500  # Сколько сессий обходим для оценки памяти
+
+
+class Session:
+    """Все данные одного пользователя в одном компактном объекте."""
+    __slots__ = ("history", "products", "state", "style", "dishes", "categories", "last_seen")
 
-class StateManager:
     def __init__(self):
-        self.history: Dict[int, List[dict]] = {}
-        self.products: Dict[int, str] = {}
-        self.user_states: Dict[int, str] = {}
-        
-        # Данные текущей сессии
-        self.generated_dishes: Dict[int, List[dict]] = {} # Список блюд (для кнопок)
-        self.available_categories: Dict[int, List[str]] = {} # Доступные категории (soup, main...)
+        self.history: List[dict] = []
+        self.products: Optional[ProductSet] = None
+        self.state: Optional[str] = None
+        self.style: Optional[str] = None     # Выбранный стиль готовки
+        self.dishes: List[dict] = []        # Список блюд (для кнопок)
+        self.categories: List[str] = []     # Доступные категории (soup, main...)
+        self.last_seen = time.monotonic()
+
+    # --- СЕРИАЛИЗАЦИЯ (для хранилища) ---
+    def to_dict(self) -> dict:
+        return {
+            "h": self.history,
+            "p": self.products.items() if self.products else [],
+            "s": self.state,
+            "st": self.style,
+            "d": self.dishes,
+            "c": self.categories,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Session":
+        session = cls()
+        session.history = data.get("h", [])
+        session.products = ProductSet(data["p"]) if data.get("p") else None
+        session.state = data.get("s")
+        session.style = data.get("st")
+        session.dishes = data.get("d", [])
+        session.categories = data.get("c", [])
+        return session
+
+    def size_bytes(self) -> int:
+        """Примерный объем памяти сессии (сам объект + вложенные контейнеры и строки)."""
+        size = sys.getsizeof(self) + sys.getsizeof(self.history) + sys.getsizeof(self.dishes) + sys.getsizeof(self.categories)
+        for msg in self.history:
+            size += sys.getsizeof(msg) + sum(sys.getsizeof(v) for v in msg.values())
+        for dish in self.dishes:
+            size += sys.getsizeof(dish) + sum(sys.getsizeof(v) for v in dish.values())
+        size += sum(sys.getsizeof(c) for c in self.categories)
+        if self.products:
+            size += sys.getsizeof(self.products._items)
+            size += sum(sys.getsizeof(k) + sys.getsizeof(v) for k, v in self.products._items.items())
+        if self.state:
+            size += sys.getsizeof(self.state)
+        if self.style:
+            size += sys.getsizeof(self.style)
+        return size
+
+
+class StateManager:
+    def __init__(self, ttl: float = SESSION_TTL, max_sessions: int = MAX_SESSIONS, backend: Optional[StateBackend] = None):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        # Внешнее хранилище. Если оно shared, локальные сессии — лишь кеш на время апдейта
+        self.backend = backend or create_backend("memory", "")
+        self._synced: Dict[int, str] = {}  # Последняя сохраненная версия сессии (чтобы не писать без изменений)
+        # user_id -> Session, в порядке последней активности (LRU)
+        self.sessions: "OrderedDict[int, Session]" = OrderedDict()
+        self.evicted = 0
+        self._sweeper: Optional[asyncio.Task] = None
+
+    # --- ХРАНИЛИЩЕ ---
+    async def open(self):
+        await self.backend.open()
+
+    async def close(self):
+        await self.backend.close()
+
+    async def load(self, user_id: int):
+        """Подтягивает свежую сессию из общего хранилища (ее мог изменить другой процесс)."""
+        if not self.backend.shared:
+            return
+        data = await self.backend.load(user_id)
+        if data is None:
+            self.sessions.pop(user_id, None)
+            self._synced.pop(user_id, None)
+            return
+        self.sessions[user_id] = Session.from_dict(data)
+        self.sessions.move_to_end(user_id)
+        self._synced[user_id] = json.dumps(data, ensure_ascii=False, sort_keys=True)
+
+    async def commit(self, user_id: int):
+        """Сохраняет сессию в общее хранилище, если она изменилась."""
+        if not self.backend.shared:
+            return
+        session = self.sessions.get(user_id)
+        data = session.to_dict() if session else None
+        raw = json.dumps(data, ensure_ascii=False, sort_keys=True) if data is not None else None
+        if raw == self._synced.get(user_id):
+            return
+        await self.backend.save(user_id, data)
+        if raw is None:
+            self._synced.pop(user_id, None)
+        else:
+            self._synced[user_id] = raw
+
+    # --- СЕССИИ ---
+    def _get(self, user_id: int, create: bool = False) -> Optional[Session]:
+        session = self.sessions.get(user_id)
+        now = time.monotonic()
+        if session is not None and now - session.last_seen > self.ttl:
+            del self.sessions[user_id]
+            self._synced.pop(user_id, None)
+            self.evicted += 1
+            session = None
+        if session is None:
+            if not create:
+                return None
+            session = Session()
+            self.sessions[user_id] = session
+            while len(self.sessions) > self.max_sessions:
+                evicted_id, _ = self.sessions.popitem(last=False)
+                self._synced.pop(evicted_id, None)
+                self.evicted += 1
+        else:
+            self.sessions.move_to_end(user_id)
+        session.last_seen = now
+        return session
+
+    def sweep(self) -> int:
+        """Удаляет сессии, простаивающие дольше TTL. Возвращает число удаленных."""
+        deadline = time.monotonic() - self.ttl
+        removed = 0
+        # Самые давние сессии в начале OrderedDict — идем, пока не встретим свежую
+        while self.sessions:
+            user_id, session = next(iter(self.sessions.items()))
+            if session.last_seen >= deadline:
+                break
+            del self.sessions[user_id]
+            self._synced.pop(user_id, None)
+            removed += 1
+        self.evicted += removed
+        return removed
+
+    async def _sweep_loop(self):
+        while True:
+            await asyncio.sleep(SESSION_SWEEP_INTERVAL)
+            removed = self.sweep()
+            try:
+                await self.backend.purge(time.time() - self.ttl)
+            except Exception as e:
+                logger.error(f"Session purge error: {e}")
+            if removed:
+                logger.info(f"🧹 Sessions swept: {removed}, active: {len(self.sessions)}, ~{self.memory_usage() // 1024} KiB")
+
+    def start_sweeper(self):
+        if self._sweeper is None or self._sweeper.done():
+            self._sweeper = asyncio.create_task(self._sweep_loop())
+
+    async def stop_sweeper(self):
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            try:
+                await self._sweeper
+            except asyncio.CancelledError:
+                pass
+            self._sweeper = None
+
+    def session_count(self) -> int:
+        return len(self.sessions)
+
+    def memory_usage(self, sample: int = MEMORY_SAMPLE) -> int:
+        """Примерный объем памяти всех сессий, байт.
+
+        Считаем по случайной выборке из sample сессий: полный обход 50k сессий занимает ~1 с
+        и блокировал бы цикл событий на каждом опросе /metrics.
+        """
+        total = len(self.sessions)
+        if total <= sample:
+            return sys.getsizeof(self.sessions) + sum(s.size_bytes() for s in self.sessions.values())
+        picked = random.sample(list(self.sessions.values()), sample)
+        return sys.getsizeof(self.sessions) + sum(s.size_bytes() for s in picked) * total // sample
+
+    def stats(self) -> Dict[str, int]:
+        return {"sessions": self.session_count(), "memory_bytes": self.memory_usage(), "evicted": self.evicted}
+
+    # --- СНАПШОТ ---
+    def dump(self) -> List[tuple]:
+        """[(user_id, сек простоя, данные)] от давних к свежим — для снапшота при остановке."""
+        now = time.monotonic()
+        return [(user_id, now - s.last_seen, s.to_dict()) for user_id, s in self.sessions.items()
+                if now - s.last_seen <= self.ttl]
+
+    def restore(self, entries: List[tuple], elapsed: float = 0) -> int:
+        """Поднимает сессии из снапшота (elapsed — сколько бот был выключен). Возвращает число поднятых.
+
+        Сессии, созданные после старта, не перезаписываются; поднятые встают в хвост LRU.
+        """
+        now = time.monotonic()
+        restored = 0
+        for user_id, idle, data in reversed(entries):
+            idle += elapsed
+            if idle > self.ttl or user_id in self.sessions:
+                continue
+            session = Session.from_dict(data)
+            session.last_seen = now - idle
+            self.sessions[user_id] = session
+            self.sessions.move_to_end(user_id, last=False)
+            restored += 1
+        while len(self.sessions) > self.max_sessions:
+            self.sessions.popitem(last=False)
+        return restored
 
     # --- ИСТОРИЯ ---
     def get_history(self, user_id: int) -> List[dict]:
-        return self.history.get(user_id, [])
+        session = self._get(user_id)
+        return session.history if session else []
 
     def add_message(self, user_id: int, role: str, text: str):
-        if user_id not in self.history:
-            self.history[user_id] = []
-        self.history[user_id].append({"role": role, "text": text})
-        if len(self.history[user_id]) > MAX_HISTORY_MESSAGES:
-            self.history[user_id] = self.history[user_id][-MAX_HISTORY_MESSAGES:]
+        session = self._get(user_id, create=True)
+        session.history.append({"role": role, "text": text})
+        if len(session.history) > MAX_HISTORY_MESSAGES:
+            session.history = session.history[-MAX_HISTORY_MESSAGES:]
 
     def get_last_bot_message(self, user_id: int) -> Optional[str]:
         hist = self.get_history(user_id)
@@ -31,53 +242,72 @@ class StateManager:
 
     # --- ПРОДУКТЫ ---
     def set_products(self, user_id: int, products: str):
-        self.products[user_id] = products
+        self._get(user_id, create=True).products = ProductSet.from_text(products)
 
     def get_products(self, user_id: int) -> Optional[str]:
-        return self.products.get(user_id)
+        """Продукты одной строкой (без дублей) — в таком виде они уходят в промпт."""
+        session = self._get(user_id)
+        return str(session.products) if session and session.products else None
 
-    def append_products(self, user_id: int, new_products: str):
-        current = self.products.get(user_id)
-        if current:
-            self.products[user_id] = f"{current}, {new_products}"
-        else:
-            self.products[user_id] = new_products
+    def get_products_key(self, user_id: int) -> Optional[str]:
+        """Стабильный ключ набора продуктов (для кешей)."""
+        session = self._get(user_id)
+        return session.products.key() if session and session.products else None
+
+    def append_products(self, user_id: int, new_products: str) -> List[str]:
+        """Добавляет продукты в набор, возвращает только реально новые."""
+        session = self._get(user_id, create=True)
+        if session.products is None:
+            session.products = ProductSet()
+        return session.products.add_text(new_products)
 
     # --- СТАТУСЫ ---
     def set_state(self, user_id: int, state: str):
-        self.user_states[user_id] = state
+        self._get(user_id, create=True).state = state
 
     def get_state(self, user_id: int) -> Optional[str]:
-        return self.user_states.get(user_id)
+        session = self._get(user_id)
+        return session.state if session else None
 
     def clear_state(self, user_id: int):
-        if user_id in self.user_states:
-            del self.user_states[user_id]
+        session = self._get(user_id)
+        if session:
+            session.state = None
+
+    # --- СТИЛЬ ---
+    def set_style(self, user_id: int, style: str):
+        self._get(user_id, create=True).style = style
+
+    def get_style(self, user_id: int) -> Optional[str]:
+        session = self._get(user_id)
+        return session.style if session else None
 
     # --- НОВОЕ: КАТЕГОРИИ ---
     def set_categories(self, user_id: int, categories: List[str]):
         """Сохраняет список кодов категорий: ['soup', 'main', 'drink']"""
-        self.available_categories[user_id] = categories
+        self._get(user_id, create=True).categories = categories
 
     def get_categories(self, user_id: int) -> List[str]:
-        return self.available_categories.get(user_id, [])
+        session = self._get(user_id)
+        return session.categories if session else []
 
     # --- БЛЮДА ---
     def set_generated_dishes(self, user_id: int, dishes: List[dict]):
-        self.generated_dishes[user_id] = dishes
+        self._get(user_id, create=True).dishes = dishes
+
+    def get_generated_dishes(self, user_id: int) -> List[dict]:
+        session = self._get(user_id)
+        return session.dishes if session else []
 
     def get_generated_dish(self, user_id: int, index: int) -> Optional[str]:
-        dishes = self.generated_dishes.get(user_id, [])
+        session = self._get(user_id)
+        dishes = session.dishes if session else []
         if 0 <= index < len(dishes):
             return dishes[index]['name']
         return None
 
     # --- ОЧИСТКА ---
     def clear_session(self, user_id: int):
-        if user_id in self.history: del self.history[user_id]
-        if user_id in self.products: del self.products[user_id]
-        if user_id in self.user_states: del self.user_states[user_id]
-        if user_id in self.generated_dishes: del self.generated_dishes[user_id]
-        if user_id in self.available_categories: del self.available_categories[user_id]
+        self.sessions.pop(user_id, None)
 
-state_manager = StateManager()
\ No newline at end of file
+state_manager = StateManager(backend=create_backend(STATE_BACKEND, STATE_DB_PATH))
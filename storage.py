@@ -0,0 +1,189 @@
+import asyncio
+import json
+import logging
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class StateBackend:
+    """Хранилище сессий за StateManager.
+
+    shared=True означает, что хранилище видят несколько процессов: тогда StateManager
+    перечитывает сессию перед каждым апдейтом и сохраняет после.
+    """
+    shared = False
+
+    async def open(self):
+        pass
+
+    async def close(self):
+        pass
+
+    async def load(self, user_id: int) -> Optional[dict]:
+        raise NotImplementedError
+
+    async def save(self, user_id: int, data: Optional[dict]):
+        """Сохраняет сессию. data=None — удалить."""
+        raise NotImplementedError
+
+    async def purge(self, older_than: float) -> int:
+        """Удаляет сессии, не обновлявшиеся с момента older_than (unix time)."""
+        return 0
+
+
+class MemoryBackend(StateBackend):
+    """Хранилище в памяти процесса (поведение по умолчанию: сессии живут в самом StateManager)."""
+
+    def __init__(self, shared: bool = False):
+        self.shared = shared
+        self._data: Dict[int, Tuple[float, dict]] = {}
+
+    async def load(self, user_id: int) -> Optional[dict]:
+        item = self._data.get(user_id)
+        return item[1] if item else None
+
+    async def save(self, user_id: int, data: Optional[dict]):
+        if data is None:
+            self._data.pop(user_id, None)
+        else:
+            self._data[user_id] = (time.time(), data)
+
+    async def purge(self, older_than: float) -> int:
+        old = [uid for uid, (ts, _) in self._data.items() if ts < older_than]
+        for uid in old:
+            del self._data[uid]
+        return len(old)
+
+
+class SQLiteBackend(StateBackend):
+    """SQLite в режиме WAL: несколько процессов-воркеров делят один файл сессий.
+
+    Записи копятся и пишутся пачкой в одной транзакции (group commit): save()
+    возвращается, когда пачка с этой сессией реально записана.
+    """
+    shared = True
+
+    def __init__(self, path: str, batch_delay: float = 0.02, batch_size: int = 200):
+        self.path = path
+        self.batch_delay = batch_delay
+        self.batch_size = batch_size
+        self._conn: Optional[sqlite3.Connection] = None
+        # Один поток: соединение SQLite не делим между потоками
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite-state")
+        self._pending: Dict[int, Optional[str]] = {}
+        self._waiters: List[asyncio.Future] = []
+        self._wakeup: Optional[asyncio.Event] = None
+        self._writer: Optional[asyncio.Task] = None
+        self._closing = False
+
+    async def _run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=10, isolation_level=None, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            "user_id INTEGER PRIMARY KEY, data TEXT NOT NULL, updated REAL NOT NULL)"
+        )
+        self._conn = conn
+
+    async def open(self):
+        if self._conn is None:
+            await self._run(self._connect)
+            self._wakeup = asyncio.Event()
+            self._writer = asyncio.create_task(self._write_loop())
+            logger.info(f"🗄 SQLite state backend: {self.path}")
+
+    async def close(self):
+        if self._writer is not None:
+            self._closing = True
+            self._wakeup.set()
+            await self._writer
+            self._writer = None
+        # Дописываем то, что не успело уйти
+        await self._flush()
+        if self._conn is not None:
+            await self._run(self._conn.close)
+            self._conn = None
+        self._executor.shutdown(wait=True)
+
+    # --- ЧТЕНИЕ ---
+    def _select(self, user_id: int) -> Optional[str]:
+        row = self._conn.execute("SELECT data FROM sessions WHERE user_id = ?", (user_id,)).fetchone()
+        return row[0] if row else None
+
+    async def load(self, user_id: int) -> Optional[dict]:
+        # Свои же несохраненные записи видны сразу
+        if user_id in self._pending:
+            raw = self._pending[user_id]
+        else:
+            raw = await self._run(self._select, user_id)
+        return json.loads(raw) if raw else None
+
+    # --- ЗАПИСЬ ---
+    async def save(self, user_id: int, data: Optional[dict]):
+        self._pending[user_id] = json.dumps(data, ensure_ascii=False) if data is not None else None
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        self._wakeup.set()
+        await waiter
+
+    def _write_batch(self, batch: Dict[int, Optional[str]]):
+        now = time.time()
+        upserts = [(uid, raw, now) for uid, raw in batch.items() if raw is not None]
+        deletes = [(uid,) for uid, raw in batch.items() if raw is None]
+        with self._conn:
+            self._conn.execute("BEGIN IMMEDIATE")
+            if upserts:
+                self._conn.executemany(
+                    "INSERT INTO sessions (user_id, data, updated) VALUES (?, ?, ?) "
+                    "ON CONFLICT(user_id) DO UPDATE SET data = excluded.data, updated = excluded.updated",
+                    upserts,
+                )
+            if deletes:
+                self._conn.executemany("DELETE FROM sessions WHERE user_id = ?", deletes)
+
+    async def _flush(self):
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, {}
+        waiters, self._waiters = self._waiters, []
+        try:
+            await self._run(self._write_batch, batch)
+        except Exception as e:
+            logger.error(f"SQLite batch write error: {e}")
+            for w in waiters:
+                if not w.done(): w.set_exception(e)
+            return
+        for w in waiters:
+            if not w.done(): w.set_result(None)
+
+    async def _write_loop(self):
+        while not self._closing:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            # Небольшое окно, чтобы собрать записи соседних апдейтов в одну транзакцию
+            if not self._closing and len(self._pending) < self.batch_size:
+                await asyncio.sleep(self.batch_delay)
+            await self._flush()
+
+    def _delete_old(self, older_than: float) -> int:
+        with self._conn:
+            return self._conn.execute("DELETE FROM sessions WHERE updated < ?", (older_than,)).rowcount
+
+    async def purge(self, older_than: float) -> int:
+        return await self._run(self._delete_old, older_than)
+
+
+def create_backend(kind: str, path: str) -> StateBackend:
+    if kind == "sqlite":
+        return SQLiteBackend(path)
+    if kind != "memory":
+        logger.error(f"Unknown STATE_BACKEND={kind!r}, falling back to memory")
+    return MemoryBackend()
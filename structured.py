@@ -0,0 +1,137 @@
+import json
+import re
+from typing import Any, Callable, List, Optional, Tuple
+
+# Разбор JSON из ответов GPT: модель оборачивает его в текст и ```-блоки, ставит лишние запятые,
+# одинарные кавычки, а при упоре в max_tokens обрывает на середине
+
+_CLOSERS = {"[": "]", "{": "}"}
+_LITERALS = {"True": "true", "False": "false", "None": "null"}
+_LITERAL_RE = re.compile(r"(True|False|None)\b")
+MAX_OPENERS = 3      # Сколько кандидатов "[" / "{" в тексте пробуем
+MAX_TRUNCATIONS = 5  # Сколько последних элементов оборванного ответа можно отбросить
+
+
+def _scan(text: str, start: int) -> Tuple[Optional[int], List[str], Optional[str], List[int]]:
+    """Идет от открывающей скобки с учетом строк. Возвращает (конец или None, незакрытые скобки,
+    незакрытая кавычка, позиции запятых вне строк)."""
+    stack: List[str] = []
+    commas: List[int] = []
+    quote = None
+    escape = False
+    for i in range(start, len(text)):
+        ch = text[i]
+        if quote:
+            if escape:
+                escape = False
+            elif ch == "\\":
+                escape = True
+            elif ch == quote:
+                quote = None
+        elif ch in "\"'":
+            quote = ch
+        elif ch in _CLOSERS:
+            stack.append(_CLOSERS[ch])
+        elif ch in "]}":
+            if not stack or ch != stack[-1]:
+                return None, [], None, []
+            stack.pop()
+            if not stack:
+                return i + 1, [], None, commas
+        elif ch == ",":
+            commas.append(i)
+    return None, stack, quote, commas
+
+
+def _normalize(raw: str) -> str:
+    """Одинарные кавычки -> двойные, True/None -> true/null, убирает запятые перед ] и }."""
+    out: List[str] = []
+    i, n = 0, len(raw)
+    while i < n:
+        ch = raw[i]
+        if ch in "\"'":
+            j, buf = i + 1, []
+            while j < n and raw[j] != ch:
+                if raw[j] == "\\" and j + 1 < n:
+                    buf.append("'" if raw[j + 1] == "'" else raw[j:j + 2])
+                    j += 2
+                    continue
+                if ch == "'" and raw[j] == '"':
+                    buf.append('\\"')
+                elif raw[j] == "\n":
+                    buf.append("\\n")
+                else:
+                    buf.append(raw[j])
+                j += 1
+            out.append('"' + "".join(buf) + '"')
+            i = j + 1
+            continue
+        if ch in "]}":
+            k = len(out) - 1
+            while k >= 0 and out[k].isspace():
+                k -= 1
+            if k >= 0 and out[k] == ",":
+                del out[k]
+        m = _LITERAL_RE.match(raw, i)
+        if m and not (out and (out[-1][-1:].isalnum() or out[-1] == "_")):
+            out.append(_LITERALS[m.group()])
+            i = m.end()
+            continue
+        out.append(ch)
+        i += 1
+    return "".join(out)
+
+
+def _close(piece: str) -> str:
+    """Дописывает незакрытую строку и скобки оборванного фрагмента."""
+    _, stack, quote, _ = _scan(piece, 0)
+    return piece + (quote or "") + "".join(reversed(stack))
+
+
+def _loads(raw: str) -> Tuple[Any, bool]:
+    try:
+        return json.loads(raw), False
+    except ValueError:
+        return json.loads(_normalize(raw)), True
+
+
+def extract_json(text: str) -> Tuple[Any, bool]:
+    """Первый JSON-массив или объект в тексте. Возвращает (значение, пришлось_чинить).
+
+    ValueError — если починить не удалось.
+    """
+    text = text or ""
+    starts = [i for i, ch in enumerate(text) if ch in _CLOSERS][:MAX_OPENERS]
+    for start in starts:
+        end, _, _, commas = _scan(text, start)
+        if end is not None:
+            try:
+                return _loads(text[start:end])
+            except ValueError:
+                continue
+        # Ответ оборван: отбрасываем недописанные элементы с конца и закрываем скобки.
+        # Если обрыв пришелся не на середину строки, сначала пробуем закрыть как есть
+        cuts = [text[start:c] for c in reversed(commas)][:MAX_TRUNCATIONS]
+        pieces = cuts + [text[start:]] if _scan(text, start)[2] else [text[start:]] + cuts
+        for piece in pieces:
+            try:
+                value, _ = _loads(_close(piece))
+                return value, True
+            except ValueError:
+                continue
+    raise ValueError("no JSON found")
+
+
+def parse_structured(text: str, validate: Callable[[Any], Any]) -> Tuple[Optional[Any], str]:
+    """extract_json + проверка схемы. Возвращает (значение или None, исход: ok | repaired | invalid | failed).
+
+    validate приводит значение к нужному виду или бросает ValueError/TypeError/KeyError.
+    """
+    try:
+        value, repaired = extract_json(text)
+    except ValueError:
+        return None, "failed"
+    try:
+        return validate(value), "repaired" if repaired else "ok"
+    except (ValueError, TypeError, KeyError, AttributeError):
+        return None, "invalid"
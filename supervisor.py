@@ -0,0 +1,267 @@
+"""Режим нескольких процессов: один вход для webhook и N воркеров, каждый — обычный бот.
+
+Супервизор не разбирает апдейты целиком: достает user_id и пересылает тело воркеру, выбранному
+по кольцу согласованного хеширования. Пользователь всегда попадает в один процесс, поэтому его
+сессия (StateManager) остается локальной. Упавший воркер перезапускается; пока его нет, его
+пользователи уходят к следующему живому воркеру по кольцу.
+"""
+import asyncio
+import bisect
+import hashlib
+import hmac
+import json
+import logging
+import os
+import signal
+import sys
+import time
+from typing import Dict, Iterator, List, Optional
+import aiohttp
+from aiohttp import web
+import metrics
+from metrics import worker_up, worker_restarts, updates_routed
+from config import (
+    WEBHOOK_PATH, SNAPSHOT_PATH, WORKER_HEALTH_INTERVAL, WORKER_RESTART_BACKOFF, HASH_RING_REPLICAS,
+)
+from webhook import SECRET_HEADER
+
+logger = logging.getLogger(__name__)
+
+MAX_BACKOFF = 30.0     # Потолок паузы перед перезапуском, сек
+STABLE_AFTER = 60.0    # Воркер прожил столько — считаем, что он поднялся, и сбрасываем паузу
+MAIN_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+
+
+def _hash(key: str) -> int:
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+
+class HashRing:
+    """Кольцо согласованного хеширования: при выпадении узла переезжают только его ключи."""
+
+    def __init__(self, nodes: List[int], replicas: int = HASH_RING_REPLICAS):
+        points = sorted((_hash(f"{node}#{i}"), node) for node in nodes for i in range(replicas))
+        self._hashes = [h for h, _ in points]
+        self._nodes = [n for _, n in points]
+        self.size = len(set(nodes))
+
+    def walk(self, key: str) -> Iterator[int]:
+        """Узлы по кольцу начиная с владельца ключа, каждый по одному разу."""
+        start = bisect.bisect(self._hashes, _hash(key))
+        seen = set()
+        for i in range(len(self._nodes)):
+            node = self._nodes[(start + i) % len(self._nodes)]
+            if node not in seen:
+                seen.add(node)
+                yield node
+                if len(seen) == self.size:
+                    return
+
+
+def update_user_id(update: dict) -> Optional[int]:
+    """id пользователя из сырого апдейта (message.from, callback_query.from, ...)."""
+    for key, value in update.items():
+        if key != "update_id" and isinstance(value, dict):
+            user = value.get("from") or value.get("user")
+            if isinstance(user, dict) and "id" in user:
+                return user["id"]
+            chat = value.get("chat")
+            if isinstance(chat, dict) and "id" in chat:
+                return chat["id"]
+    return None
+
+
+class Worker:
+    """Процесс-воркер: обычный main.py на своем внутреннем порту."""
+
+    def __init__(self, index: int, port: int):
+        self.index = index
+        self.port = port
+        self.process: Optional[asyncio.subprocess.Process] = None
+        self.healthy = False
+        self.restarts = 0
+        self.started_at = 0.0
+        self.last_error = ""
+        self.backoff = WORKER_RESTART_BACKOFF
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+
+    def report(self) -> dict:
+        alive = self.process is not None and self.process.returncode is None
+        return {
+            "worker": self.index,
+            "pid": self.process.pid if alive else None,
+            "port": self.port,
+            "healthy": self.healthy,
+            "restarts": self.restarts,
+            "uptime": round(time.monotonic() - self.started_at) if alive else 0,
+            "last_error": self.last_error,
+        }
+
+
+class Supervisor:
+    def __init__(self, workers: int, base_port: int, secret: str):
+        self.secret = secret
+        self.workers: Dict[int, Worker] = {i: Worker(i, base_port + i) for i in range(workers)}
+        self.ring = HashRing(list(self.workers))
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._tasks: List[asyncio.Task] = []
+        self._runner: Optional[web.AppRunner] = None
+        self.accepting = True
+        self.stopping = False
+
+    # --- ПРОЦЕССЫ ---
+    async def _spawn(self, worker: Worker):
+        env = dict(os.environ, WORKER_INDEX=str(worker.index), PORT=str(worker.port), WEBHOOK_SECRET=self.secret)
+        if SNAPSHOT_PATH:
+            # Пользователи привязаны к воркеру, поэтому и снапшот у каждого свой
+            env["SNAPSHOT_PATH"] = f"{SNAPSHOT_PATH}.{worker.index}"
+        worker.process = await asyncio.create_subprocess_exec(sys.executable, MAIN_SCRIPT, env=env)
+        worker.started_at = time.monotonic()
+        worker.healthy = False
+        logger.info(f"👷 Worker {worker.index} started: pid {worker.process.pid}, port {worker.port}")
+
+    async def _watch(self, worker: Worker):
+        """Ждет выхода процесса и поднимает его заново (пауза растет, если воркер падает сразу)."""
+        while True:
+            code = await worker.process.wait()
+            worker.healthy = False
+            worker_up.set(0, worker=worker.index)
+            if self.stopping:
+                return
+            worker.last_error = f"exit code {code}"
+            if time.monotonic() - worker.started_at > STABLE_AFTER:
+                worker.backoff = WORKER_RESTART_BACKOFF
+            logger.error(f"Worker {worker.index} exited with {code}, restarting in {worker.backoff:.0f}s")
+            await asyncio.sleep(worker.backoff)
+            worker.backoff = min(MAX_BACKOFF, worker.backoff * 2)
+            if self.stopping:
+                return
+            worker.restarts += 1
+            worker_restarts.inc(worker=worker.index)
+            await self._spawn(worker)
+
+    async def _check(self, worker: Worker):
+        try:
+            async with self._session.get(f"{worker.url}/health", timeout=aiohttp.ClientTimeout(total=2)) as resp:
+                healthy = resp.status == 200
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            healthy = False
+            if worker.healthy:
+                worker.last_error = f"health: {type(e).__name__}"
+        if healthy and not worker.healthy:
+            logger.info(f"Worker {worker.index} is up")
+        elif worker.healthy and not healthy:
+            logger.warning(f"Worker {worker.index} stopped answering /health")
+        worker.healthy = healthy and worker.process is not None and worker.process.returncode is None
+        worker_up.set(1 if worker.healthy else 0, worker=worker.index)
+
+    async def _health_loop(self):
+        while True:
+            await asyncio.gather(*(self._check(w) for w in self.workers.values()))
+            # Пока кто-то не поднялся — проверяем чаще, чтобы не держать его пользователей на соседях
+            starting = any(not w.healthy for w in self.workers.values())
+            await asyncio.sleep(min(0.5, WORKER_HEALTH_INTERVAL) if starting else WORKER_HEALTH_INTERVAL)
+
+    # --- МАРШРУТИЗАЦИЯ ---
+    def route(self, user_id: Optional[int], fallback: int) -> Worker:
+        """Владелец по кольцу, а если он лежит — следующий живой. Все лежат — владелец (пусть ответит 503)."""
+        key = str(user_id if user_id is not None else fallback)
+        owner = None
+        for index in self.ring.walk(key):
+            worker = self.workers[index]
+            owner = owner or worker
+            if worker.healthy:
+                return worker
+        return owner
+
+    async def handle(self, request: web.Request) -> web.Response:
+        token = request.headers.get(SECRET_HEADER, "")
+        if not hmac.compare_digest(token.encode("utf-8", "surrogateescape"), self.secret.encode()):
+            return web.Response(status=401)
+        if not self.accepting:
+            return web.Response(status=503)
+        body = await request.read()
+        try:
+            update = json.loads(body)
+            worker = self.route(update_user_id(update), update.get("update_id", 0))
+        except (ValueError, AttributeError) as e:
+            logger.error(f"Bad update payload: {e}")
+            return web.Response(status=400)
+        try:
+            async with self._session.post(f"{worker.url}{WEBHOOK_PATH}", data=body, headers={
+                SECRET_HEADER: self.secret, "Content-Type": "application/json",
+            }) as resp:
+                updates_routed.inc(worker=worker.index, result=resp.status)
+                return web.Response(status=resp.status)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            # Telegram повторит доставку; к тому времени воркер поднимется или кольцо уведет на соседа
+            worker.healthy = False
+            updates_routed.inc(worker=worker.index, result="error")
+            logger.warning(f"Worker {worker.index} unreachable: {e}")
+            return web.Response(status=503)
+
+    # --- HTTP ---
+    async def health(self, request: web.Request) -> web.Response:
+        """Состояние воркеров. 200 — пока жив хотя бы один."""
+        report = [w.report() for w in self.workers.values()]
+        status = 200 if any(w["healthy"] for w in report) else 503
+        return web.json_response({"workers": report}, status=status)
+
+    async def worker_metrics(self, request: web.Request) -> web.Response:
+        """Метрики воркера (каждый считает свои — так их и собирать: /workers/<i>/metrics)."""
+        worker = self.workers.get(int(request.match_info["index"]))
+        if worker is None:
+            return web.Response(status=404)
+        try:
+            async with self._session.get(f"{worker.url}/metrics", timeout=aiohttp.ClientTimeout(total=5)) as resp:
+                return web.Response(text=await resp.text(), status=resp.status, content_type="text/plain", charset="utf-8")
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            return web.Response(status=503)
+
+    async def metrics_handler(self, request: web.Request) -> web.Response:
+        return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8")
+
+    # --- ЗАПУСК И ОСТАНОВКА ---
+    async def start(self, port: int):
+        self._session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=0), timeout=aiohttp.ClientTimeout(total=60))
+        for worker in self.workers.values():
+            await self._spawn(worker)
+        self._tasks = [asyncio.create_task(self._watch(w)) for w in self.workers.values()]
+        self._tasks.append(asyncio.create_task(self._health_loop()))
+
+        app = web.Application()
+        app.router.add_get("/", self.health)
+        app.router.add_get("/health", self.health)
+        app.router.add_get("/metrics", self.metrics_handler)
+        app.router.add_get(r"/workers/{index:\d+}/metrics", self.worker_metrics)
+        app.router.add_post(WEBHOOK_PATH, self.handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, "0.0.0.0", port).start()
+        logger.info(f"🌍 Supervisor on port {port}: {len(self.workers)} workers")
+
+    async def stop(self, timeout: float):
+        """Перестает принимать апдейты, шлет воркерам SIGTERM и ждет их (не дольше timeout), потом убивает."""
+        self.accepting = False
+        self.stopping = True
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        alive = [w.process for w in self.workers.values() if w.process is not None and w.process.returncode is None]
+        for process in alive:
+            process.send_signal(signal.SIGTERM)
+        try:
+            await asyncio.wait_for(asyncio.gather(*(p.wait() for p in alive)), timeout)
+        except asyncio.TimeoutError:
+            for process in alive:
+                if process.returncode is None:
+                    logger.warning(f"Worker pid {process.pid} did not stop in {timeout:.0f}s, killing")
+                    process.kill()
+            await asyncio.gather(*(p.wait() for p in alive))
+        if self._runner is not None:
+            await self._runner.cleanup()
+        await self._session.close()
@@ -0,0 +1,49 @@
+import asyncio
+from singleflight import SingleFlight
+
+
+def test_new_call_after_last_waiter_cancelled_starts_fresh_flight():
+    """Последний ожидающий отменен — следующий вызов с тем же ключом не получает его CancelledError."""
+    async def scenario():
+        sf = SingleFlight()
+        calls = 0
+
+        async def call():
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.05)
+            return calls
+
+        first = asyncio.create_task(sf.do("k", call))
+        await asyncio.sleep(0)
+        first.cancel()
+        await asyncio.sleep(0)
+        # Отмененный запрос еще не успел завершиться, а новый вызов уже пришел
+        result = await sf.do("k", call)
+        return first, result, calls, sf.stats()
+
+    first, result, calls, stats = asyncio.run(scenario())
+    assert first.cancelled()
+    assert result == 2
+    assert calls == 2
+    assert stats["in_flight"] == 0
+
+
+def test_concurrent_calls_share_one_flight():
+    async def scenario():
+        sf = SingleFlight()
+        calls = 0
+
+        async def call():
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.01)
+            return "ok"
+
+        results = await asyncio.gather(*(sf.do("k", call) for _ in range(5)))
+        return results, calls, sf.stats()
+
+    results, calls, stats = asyncio.run(scenario())
+    assert results == ["ok"] * 5
+    assert calls == 1
+    assert stats["deduplicated"] == 4
@@ -0,0 +1,71 @@
+import asyncio
+import hmac
+import logging
+from typing import List, Optional
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class WebhookIngress:
+    """Прием апдейтов через webhook: проверка секрета, ограниченная очередь и пул воркеров."""
+
+    def __init__(self, bot: Bot, dp: Dispatcher, secret: str, queue_size: int, workers: int):
+        self.bot = bot
+        self.dp = dp
+        self.secret = secret
+        self.workers = workers
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self._tasks: List[asyncio.Task] = []
+        self.accepting = True
+
+    # --- ПРИЕМ ---
+    async def handle(self, request: web.Request) -> web.Response:
+        token = request.headers.get(SECRET_HEADER, "")
+        if not hmac.compare_digest(token.encode("utf-8", "surrogateescape"), self.secret.encode()):
+            return web.Response(status=401)
+        if not self.accepting:
+            return web.Response(status=503)
+        try:
+            update = Update.model_validate(await request.json(), context={"bot": self.bot})
+        except Exception as e:
+            logger.error(f"Bad update payload: {e}")
+            return web.Response(status=400)
+        try:
+            self.queue.put_nowait(update)
+        except asyncio.QueueFull:
+            # Telegram повторит доставку позже — это и есть наш backpressure
+            logger.warning("Update queue is full, asking Telegram to retry")
+            return web.Response(status=503)
+        return web.Response()
+
+    # --- ОБРАБОТКА ---
+    async def _worker(self):
+        while True:
+            update = await self.queue.get()
+            try:
+                await self.dp.feed_update(self.bot, update)
+            except Exception as e:
+                logger.error(f"Update {update.update_id} failed: {e}")
+            finally:
+                self.queue.task_done()
+
+    async def start(self):
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        logger.info(f"📥 Webhook ingress: {self.workers} workers, queue {self.queue.maxsize}")
+
+    async def stop(self, timeout: Optional[float] = None):
+        """Перестает принимать апдейты, дожидается очереди (не дольше timeout) и гасит воркеров."""
+        self.accepting = False
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Webhook queue not drained, dropped: {self.queue.qsize()}")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
@@ -1,79 +1,532 @@
 import aiohttp
+import asyncio
+import hashlib
 import json
 import logging
-from typing import List, Dict
-from config import YANDEX_API_KEY, YANDEX_FOLDER_ID
+import time
+from typing import AsyncIterable, AsyncIterator, List, Dict, NamedTuple, Optional, Union
+from cache import SimilarityCache, TTLCache
+from scheduler import ApiScheduler, Priority, RetryableError, SchedulerBusy
+from singleflight import SingleFlight
+from metrics import instrumented, yandex_errors, gpt_latency, gpt_hedges, gpt_parse
+from products import products_key
+from classifier import classifier
+from structured import parse_structured
+from config import (
+    YANDEX_API_KEY, YANDEX_FOLDER_ID, YANDEX_GPT_URL, YANDEX_STT_URL,
+    HTTP_POOL_LIMIT, HTTP_POOL_LIMIT_PER_HOST, HTTP_KEEPALIVE_TIMEOUT, HTTP_DNS_CACHE_TTL,
+    HTTP_CONNECT_TIMEOUT, GPT_TIMEOUT, STT_TIMEOUT, STT_CACHE_MAX_ITEMS,
+    CACHE_MAX_ITEMS, CACHE_TTL,
+    SIMILAR_CACHE_THRESHOLD, SIMILAR_CACHE_MAX_ITEMS, SIMILAR_CACHE_TTL,
+    YANDEX_RPS, YANDEX_BURST, YANDEX_CONCURRENCY, YANDEX_MAX_RETRIES, YANDEX_BACKOFF_BASE, YANDEX_BACKOFF_MAX,
+    YANDEX_QUEUE_INTERACTIVE, YANDEX_QUEUE_NORMAL, YANDEX_QUEUE_BACKGROUND,
+    YANDEX_MODEL, YANDEX_MODEL_LITE, GPT_ROUTES,
+    YANDEX_HEDGE, YANDEX_HEDGE_DELAY, YANDEX_HEDGE_DEFAULT_DELAY, YANDEX_HEDGE_MIN_SAMPLES,
+    GPT_JSON_REASKS,
+)
 
-GPT_URL = "https://llm.api.cloud.yandex.net/foundationModels/v1/completion"
-STT_URL = "https://stt.api.cloud.yandex.net/speech/v1/stt:recognize"
+GPT_URL = YANDEX_GPT_URL
+STT_URL = YANDEX_STT_URL
+
+# Категории, которые умеет показывать бот
+CATEGORY_KEYS = ("soup", "main", "salad", "breakfast", "dessert", "drink", "snack")
+
+# Сетевые ошибки, после которых запрос имеет смысл повторить
+TRANSIENT_ERRORS = (asyncio.TimeoutError, aiohttp.ClientConnectionError)
+# Статус промежуточного чанка в stream-режиме; у последнего — ALTERNATIVE_STATUS_FINAL и т.п.
+STATUS_PARTIAL = "ALTERNATIVE_STATUS_PARTIAL"
+
+
+class Route(NamedTuple):
+    model: str
+    max_tokens: int
+
+
+DEFAULT_ROUTE = Route(YANDEX_MODEL, 1500)
+
+
+def parse_routes(spec: str) -> Dict[str, Route]:
+    """"analyze_categories=lite:60,generate_recipe=pro:1500" -> {метод: Route}."""
+    routes = {}
+    for part in spec.split(","):
+        method, _, target = part.partition("=")
+        if not target:
+            continue
+        model, _, tokens = target.partition(":")
+        model = {"lite": YANDEX_MODEL_LITE, "pro": YANDEX_MODEL}.get(model.strip(), model.strip())
+        routes[method.strip()] = Route(model, int(tokens) if tokens.strip() else DEFAULT_ROUTE.max_tokens)
+    return routes
+
+
+# Дешевые классификации — в lite с коротким ответом, генерация — в основную модель
+ROUTES = parse_routes(GPT_ROUTES)
+
+
+# --- СХЕМЫ ОТВЕТОВ ---
+# Приводят разобранный JSON к виду, который ждут хендлеры, или бросают ValueError/TypeError
+def _as_categories(data) -> List[str]:
+    if not isinstance(data, list):
+        raise TypeError("categories: list expected")
+    # "Main", " soup" — те же ключи; неизвестные ("супы") отбрасываем
+    categories = []
+    for item in data:
+        key = item.strip().lower() if isinstance(item, str) else None
+        if key in CATEGORY_KEYS and key not in categories:
+            categories.append(key)
+    if data and not categories:
+        raise ValueError("categories: no known key")
+    return categories
+
+
+def _as_dishes(data) -> List[Dict[str, str]]:
+    if not isinstance(data, list):
+        raise TypeError("dishes: list expected")
+    dishes = []
+    for item in data:
+        if isinstance(item, dict) and isinstance(item.get("name"), str) and item["name"].strip():
+            dishes.append({"name": item["name"].strip(), "desc": str(item.get("desc") or "")})
+    if data and not dishes:
+        raise ValueError("dishes: no item with a name")
+    return dishes
+
+
+def _as_intent(data) -> dict:
+    if not isinstance(data, dict) or not isinstance(data.get("intent"), str):
+        raise TypeError("intent: object with intent expected")
+    return data
+
+
+def _as_analysis(data) -> dict:
+    if not isinstance(data, dict) or "valid" not in data:
+        raise TypeError("analysis: object with valid expected")
+    products = data.get("products") or []
+    if isinstance(products, str):
+        products = [products]
+    return {
+        "valid": bool(data.get("valid")),
+        "intent": data.get("intent") or "unclear",
+        "products": [str(p) for p in products if p],
+        "dish_name": data.get("dish_name") or "",
+        "categories": _analysis_categories(data.get("categories")),
+    }
+
+
+def _analysis_categories(data) -> List[str]:
+    """Категории в объединенном анализе необязательны: без них спросим analyze_categories."""
+    try:
+        return _as_categories(data or [])
+    except ValueError:
+        return []
+
+
+def _as_validity(data) -> bool:
+    if not isinstance(data, dict) or not isinstance(data.get("valid"), bool):
+        raise TypeError("validity: object with boolean valid expected")
+    return data["valid"]
 
 class YandexService:
+    # Общая сессия с пулом соединений: один TCP/TLS-хендшейк на соединение, а не на каждый запрос
+    _session: Optional[aiohttp.ClientSession] = None
+
+    # Кеши ответов: одинаковые продукты/категория/блюдо не гоняем в GPT повторно
+    categories_cache = TTLCache("categories", CACHE_MAX_ITEMS, CACHE_TTL)
+    dishes_cache = TTLCache("dishes", CACHE_MAX_ITEMS, CACHE_TTL)
+    recipes_cache = TTLCache("recipes", CACHE_MAX_ITEMS, CACHE_TTL)
+    analysis_cache = TTLCache("analysis", CACHE_MAX_ITEMS, CACHE_TTL)
+    # Пересланное или повторно отправленное голосовое не распознаем заново (ключ — file_unique_id)
+    stt_cache = TTLCache("stt", STT_CACHE_MAX_ITEMS, CACHE_TTL)
+    # Второй уровень: ответ для почти такого же набора продуктов ("курица, рис" ~ "рис, курица, лук")
+    similar_categories = SimilarityCache("categories_similar", SIMILAR_CACHE_MAX_ITEMS, SIMILAR_CACHE_TTL, SIMILAR_CACHE_THRESHOLD)
+    similar_dishes = SimilarityCache("dishes_similar", SIMILAR_CACHE_MAX_ITEMS, SIMILAR_CACHE_TTL, SIMILAR_CACHE_THRESHOLD)
+
+    # Все запросы к GPT идут через общий планировщик: лимит RPS, параллельность, приоритеты, повторы
+    scheduler = ApiScheduler(
+        rps=YANDEX_RPS, burst=YANDEX_BURST, concurrency=YANDEX_CONCURRENCY,
+        lane_limits={
+            Priority.INTERACTIVE: YANDEX_QUEUE_INTERACTIVE,
+            Priority.NORMAL: YANDEX_QUEUE_NORMAL,
+            Priority.BACKGROUND: YANDEX_QUEUE_BACKGROUND,
+        },
+        max_retries=YANDEX_MAX_RETRIES, backoff_base=YANDEX_BACKOFF_BASE, backoff_max=YANDEX_BACKOFF_MAX,
+    )
+    # Одинаковые запросы, пришедшие одновременно (двойной тап, несколько пользователей), идут в GPT один раз
+    flights = SingleFlight()
+
+    # --- HTTP-КЛИЕНТ ---
+    @classmethod
+    async def start(cls):
+        """Создает общую сессию. Вызывается при старте бота."""
+        if cls._session is None or cls._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=HTTP_POOL_LIMIT,
+                limit_per_host=HTTP_POOL_LIMIT_PER_HOST,
+                keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+                ttl_dns_cache=HTTP_DNS_CACHE_TTL,
+            )
+            cls._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=GPT_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+            )
+        return cls._session
+
+    @classmethod
+    async def close(cls):
+        """Закрывает сессию и пул соединений. Вызывается при остановке бота."""
+        if cls._session is not None and not cls._session.closed:
+            await cls._session.close()
+        cls._session = None
+
+    @classmethod
+    async def _get_session(cls) -> aiohttp.ClientSession:
+        # Если start() не вызывали (скрипты, отладка) — создаем сессию лениво
+        if cls._session is None or cls._session.closed:
+            await cls.start()
+        return cls._session
+
+    # --- КЕШ ---
+    @classmethod
+    def caches(cls) -> List[TTLCache]:
+        return [cls.categories_cache, cls.dishes_cache, cls.recipes_cache, cls.analysis_cache, cls.stt_cache]
+
+    @classmethod
+    def cache_stats(cls) -> Dict[str, dict]:
+        caches = cls.caches() + [cls.similar_categories, cls.similar_dishes]
+        return {c.name: c.stats() for c in caches}
+
     # --- SPEECH KIT ---
     @staticmethod
-    async def speech_to_text(audio_bytes: bytes) -> str:
-        headers = {"Authorization": f"Api-Key {YANDEX_API_KEY}"}
-        params = {"lang": "ru-RU", "format": "oggopus", "topic": "general"}
-        async with aiohttp.ClientSession() as session:
+    @instrumented("speech_to_text")
+    async def speech_to_text(audio: Union[bytes, AsyncIterable[bytes]], cache_key: str = "", size: Optional[int] = None) -> str:
+        """Распознает голосовое. audio — байты или поток чанков (уходит в тело запроса как есть, без склейки).
+
+        cache_key (file_unique_id) включает кеш и склейку одновременных запросов; если ответ нашелся,
+        поток audio так и не читается — файл даже не скачивается.
+        """
+        if cache_key:
+            cached = YandexService.stt_cache.get(cache_key)
+            if cached is not None: return cached
+
+        consumed = False
+
+        async def call() -> str:
+            nonlocal consumed
+            consumed = True
+            headers = {"Authorization": f"Api-Key {YANDEX_API_KEY}"}
+            if size:
+                # Известный размер — обычное тело вместо chunked
+                headers["Content-Length"] = str(size)
+            params = {"lang": "ru-RU", "format": "oggopus", "topic": "general"}
+            session = await YandexService._get_session()
+            timeout = aiohttp.ClientTimeout(total=STT_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT)
             try:
-                async with session.post(STT_URL, params=params, headers=headers, data=audio_bytes) as resp:
-                    if resp.status != 200: return ""
+                async with session.post(STT_URL, params=params, headers=headers, data=audio, timeout=timeout) as resp:
+                    if resp.status != 200:
+                        yandex_errors.inc(method="stt", reason=f"http_{resp.status}")
+                        return ""
                     result = await resp.json()
-                    return result.get("result", "")
-            except Exception:
+                    text = result.get("result", "")
+            except Exception as e:
+                yandex_errors.inc(method="stt", reason=type(e).__name__)
                 return ""
+            if cache_key and text:
+                YandexService.stt_cache.set(cache_key, text)
+            return text
+
+        try:
+            if not cache_key:
+                return await call()
+            return await YandexService.flights.do(f"stt:{cache_key}", call)
+        finally:
+            # Поток, который не понадобился (кеш или чужой запрос), закрываем сами
+            if not consumed and hasattr(audio, "aclose"):
+                await audio.aclose()
 
     # --- GPT BASE ---
     @staticmethod
-    async def _send_gpt_request(system_prompt: str, user_text: str, temperature: float = 0.5, max_tokens: int = 1500) -> str:
-        headers = {
+    def _gpt_headers() -> dict:
+        return {
             "Authorization": f"Api-Key {YANDEX_API_KEY}",
             "x-folder-id": YANDEX_FOLDER_ID,
             "Content-Type": "application/json"
         }
-        body = {
-            "modelUri": f"gpt://{YANDEX_FOLDER_ID}/yandexgpt/latest",
-            "completionOptions": {"stream": False, "temperature": temperature, "maxTokens": max_tokens},
+
+    @staticmethod
+    def _gpt_body(system_prompt: str, user_text: str, temperature: float, max_tokens: int, stream: bool,
+                  model: str = YANDEX_MODEL) -> dict:
+        return {
+            "modelUri": f"gpt://{YANDEX_FOLDER_ID}/{model}",
+            "completionOptions": {"stream": stream, "temperature": temperature, "maxTokens": max_tokens},
             "messages": [
                 {"role": "system", "text": system_prompt},
                 {"role": "user", "text": user_text}
             ]
         }
-        async with aiohttp.ClientSession() as session:
+
+    @staticmethod
+    async def _raise_for_status(resp: aiohttp.ClientResponse):
+        """Для 429/5xx поднимает RetryableError, остальные ошибки просто логирует."""
+        text = await resp.text()
+        yandex_errors.inc(method="gpt", reason=f"http_{resp.status}")
+        if resp.status == 429 or resp.status >= 500:
+            retry_after = resp.headers.get("Retry-After", "")
+            raise RetryableError(f"GPT Error {resp.status}: {text[:200]}", float(retry_after) if retry_after.isdigit() else None)
+        logging.error(f"GPT Error {resp.status}: {text}")
+
+    @staticmethod
+    async def _post_gpt(body: dict, route: str = "") -> str:
+        """Один HTTP-запрос к GPT (без планировщика)."""
+        session = await YandexService._get_session()
+        timeout = aiohttp.ClientTimeout(total=GPT_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT)
+        start = time.monotonic()
+        try:
+            async with session.post(GPT_URL, headers=YandexService._gpt_headers(), json=body, timeout=timeout) as resp:
+                if resp.status != 200:
+                    await YandexService._raise_for_status(resp)
+                    return ""
+                result = await resp.json()
+                gpt_latency.observe(time.monotonic() - start, route=route)
+                return result['result']['alternatives'][0]['message']['text']
+        except TRANSIENT_ERRORS as e:
+            yandex_errors.inc(method="gpt", reason=type(e).__name__)
+            raise RetryableError(f"{type(e).__name__}: {e}")
+
+    @staticmethod
+    def _flight_key(body: dict) -> str:
+        return hashlib.sha1(json.dumps(body, ensure_ascii=False, sort_keys=True).encode()).hexdigest()
+
+    @staticmethod
+    def _routed_body(system_prompt: str, user_text: str, temperature: float, max_tokens: Optional[int],
+                     stream: bool, route: str) -> dict:
+        target = ROUTES.get(route, DEFAULT_ROUTE)
+        return YandexService._gpt_body(system_prompt, user_text, temperature, max_tokens or target.max_tokens,
+                                       stream, target.model)
+
+    @staticmethod
+    def _hedge_delay(route: str) -> float:
+        if YANDEX_HEDGE_DELAY > 0:
+            return YANDEX_HEDGE_DELAY
+        if gpt_latency.count(route=route) < YANDEX_HEDGE_MIN_SAMPLES:
+            return YANDEX_HEDGE_DEFAULT_DELAY
+        return gpt_latency.quantile(0.95, route=route)
+
+    @staticmethod
+    async def _hedged(body: dict, priority: Optional[Priority], route: str) -> str:
+        """Если основной запрос не ответил за p95, шлем второй такой же; берем первый успешный, второй отменяем."""
+        scheduler = YandexService.scheduler
+        primary = asyncio.create_task(scheduler.run(lambda: YandexService._post_gpt(body, route), priority))
+        started = [primary]
+        try:
+            done, _ = await asyncio.wait(started, timeout=YandexService._hedge_delay(route))
+            # Дублируем, только если у планировщика есть свободное место — под нагрузкой это лишняя очередь
+            if not done and scheduler.has_capacity():
+                started.append(asyncio.create_task(scheduler.run(lambda: YandexService._post_gpt(body, route), priority)))
+            pending = set(started)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if len(started) > 1:
+                            gpt_hedges.inc(route=route, winner="primary" if task is primary else "backup")
+                        return task.result()
+            return primary.result()  # Оба упали — пробрасываем ошибку основного
+        finally:
+            for task in started:
+                if task.done() and not task.cancelled():
+                    task.exception()  # Ошибку проигравшего уже не ждем — помечаем прочитанной
+                task.cancel()
+
+    @staticmethod
+    async def _send_gpt_request(system_prompt: str, user_text: str, temperature: float = 0.5, max_tokens: Optional[int] = None,
+                                priority: Optional[Priority] = None, route: str = "") -> str:
+        body = YandexService._routed_body(system_prompt, user_text, temperature, max_tokens, False, route)
+        if YANDEX_HEDGE:
+            call = lambda: YandexService._hedged(body, priority, route)
+        else:
+            call = lambda: YandexService.scheduler.run(lambda: YandexService._post_gpt(body, route), priority)
+        try:
+            return await YandexService.flights.do(YandexService._flight_key(body), call)
+        except SchedulerBusy as e:
+            yandex_errors.inc(method="gpt", reason="rejected")
+            logging.warning(f"GPT request rejected: {e}")
+            return ""
+        except Exception as e:
+            if not isinstance(e, RetryableError):
+                yandex_errors.inc(method="gpt", reason=type(e).__name__)
+            logging.error(f"Request Error: {e}")
+            return ""
+
+    @staticmethod
+    async def _ask_json(system_prompt: str, user_text: str, temperature: float, route: str, validate):
+        """_send_gpt_request + разбор JSON по схеме validate. Возвращает (значение или None, сырой ответ).
+
+        Мелкие огрехи (обертка текстом, лишние запятые, обрыв по max_tokens) чинятся без нового запроса;
+        переспрашиваем, только если починить не вышло, и не больше GPT_JSON_REASKS раз.
+        """
+        res = await YandexService._send_gpt_request(system_prompt, user_text, temperature, route=route)
+        for attempt in range(GPT_JSON_REASKS + 1):
+            value, outcome = parse_structured(res, validate)
+            if attempt:
+                outcome = f"reask_{outcome}"
+            gpt_parse.inc(method=route, outcome=outcome if res else "empty")
+            # Пустой ответ — ошибка запроса, а не формата: переспрашивать бессмысленно
+            if value is not None or not res or attempt == GPT_JSON_REASKS:
+                return value, res
+            logging.warning(f"{route}: unparsable GPT answer ({outcome}), asking again: {res[:200]!r}")
+            res = await YandexService._send_gpt_request(
+                system_prompt, f"{user_text}\nОтветь строго одним валидным JSON, без пояснений и ```.",
+                0.1, route=route)
+        return None, res
+
+    @staticmethod
+    def _stream_gpt_request(system_prompt: str, user_text: str, temperature: float = 0.5, max_tokens: Optional[int] = None,
+                            priority: Optional[Priority] = None, route: str = "") -> AsyncIterator[str]:
+        """Потоковый вариант _send_gpt_request: отдает накопленный текст ответа по мере генерации.
+
+        В режиме stream API присылает по строке JSON на каждый чанк, в каждой — весь текст на данный момент.
+        Одинаковые одновременные потоки склеиваются в один. Если ответ не дошел до конца,
+        последнее значение — "" (как у _send_gpt_request при ошибке): недописанный текст за ответ не считаем.
+        """
+        body = YandexService._routed_body(system_prompt, user_text, temperature, max_tokens, True, route)
+        return YandexService.flights.stream(
+            YandexService._flight_key(body),
+            lambda: YandexService._stream_gpt(body, priority),
+        )
+
+    @staticmethod
+    async def _stream_gpt(body: dict, priority: Optional[Priority]) -> AsyncIterator[str]:
+        """Один потоковый запрос к GPT через планировщик. Повтор возможен, только пока ничего не отдано."""
+        scheduler = YandexService.scheduler
+        session = await YandexService._get_session()
+        timeout = aiohttp.ClientTimeout(total=GPT_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT)
+        attempt = 0
+        while True:
+            started = False
             try:
-                async with session.post(GPT_URL, headers=headers, json=body) as resp:
-                    if resp.status != 200:
-                        logging.error(f"GPT Error {resp.status}: {await resp.text()}")
-                        return ""
-                    result = await resp.json()
-                    return result['result']['alternatives'][0]['message']['text']
+                async with scheduler.slot(priority):
+                    async with session.post(GPT_URL, headers=YandexService._gpt_headers(), json=body, timeout=timeout) as resp:
+                        if resp.status != 200:
+                            await YandexService._raise_for_status(resp)
+                            return
+                        last = ""
+                        status = None
+                        async for line in resp.content:
+                            line = line.strip()
+                            if not line:
+                                continue
+                            chunk = json.loads(line)
+                            alternative = chunk['result']['alternatives'][0]
+                            status = alternative.get('status')
+                            text = alternative['message']['text']
+                            if text != last:
+                                last = text
+                                started = True
+                                yield text
+                if status == STATUS_PARTIAL:
+                    # Соединение закрылось без финального чанка
+                    yandex_errors.inc(method="gpt", reason="stream_incomplete")
+                    logging.error("Stream Error: answer ended before the final chunk")
+                    break
+                return
+            except (RetryableError, *TRANSIENT_ERRORS) as e:
+                if not isinstance(e, RetryableError):
+                    yandex_errors.inc(method="gpt", reason=type(e).__name__)
+                if started or attempt >= scheduler.max_retries:
+                    logging.error(f"Stream Error: {e}")
+                    break
+                error = e if isinstance(e, RetryableError) else RetryableError(f"{type(e).__name__}: {e}")
+                await scheduler.sleep_backoff(attempt, error)
+                attempt += 1
+            except SchedulerBusy as e:
+                yandex_errors.inc(method="gpt", reason="rejected")
+                logging.warning(f"GPT stream rejected: {e}")
+                return
             except Exception as e:
-                logging.error(f"Request Error: {e}")
-                return ""
+                yandex_errors.inc(method="gpt", reason=type(e).__name__)
+                logging.error(f"Stream Error: {e}")
+                break
+        # Оборвалось на середине: подписчики должны узнать, что ответа нет
+        if started:
+            yield ""
 
     # --- АНАЛИЗ КАТЕГОРИЙ ---
     @staticmethod
+    @instrumented("analyze_categories")
     async def analyze_categories(products: str) -> List[str]:
+        key = products_key(products)
+        cached = YandexService.categories_cache.get(key)
+        if cached is not None: return cached
+        cached = YandexService.similar_categories.get("", key.split(","))
+        if cached is not None: return cached
+
         prompt = f"""Ты опытный шеф-повар. Проанализируй список продуктов: "{products}".
         Определи, какие категории блюд из этого РЕАЛЬНО приготовить (имея базовые соль/воду/масло).
         Возможные категории: "soup", "main", "salad", "breakfast", "dessert", "drink", "snack".
         ВЕРНИ ТОЛЬКО JSON список ключей. Пример: ["main", "salad"]
         """
-        res = await YandexService._send_gpt_request(prompt, "Анализируй категории", 0.3)
-        try:
-            clean_json = res.replace("```json", "").replace("```", "").strip()
-            data = json.loads(clean_json)
-            if isinstance(data, list): return data
-        except: pass
-        return ["main"]
+        data, _ = await YandexService._ask_json(prompt, "Анализируй категории", 0.3, "analyze_categories", _as_categories)
+        if data is None:
+            return ["main"]
+        # Пустой список модель вернула сама (непустой без известных ключей не проходит проверку
+        # и переспрашивается) — это честный ответ "приготовить нечего", его тоже кешируем
+        YandexService.categories_cache.set(key, data)
+        YandexService.similar_categories.set("", key.split(","), data)
+        return data
+
+    # --- ОБЪЕДИНЕННЫЙ АНАЛИЗ СООБЩЕНИЯ ---
+    @staticmethod
+    @instrumented("analyze_input")
+    async def analyze_input(text: str, current_products: str = "", context: str = "") -> dict:
+        """Один запрос вместо цепочки validate_ingredients -> determine_intent -> analyze_categories.
+
+        Возвращает {"valid": bool, "intent": str, "products": [...], "dish_name": str, "categories": [...]},
+        где categories посчитаны для ВСЕХ продуктов (уже имеющихся + новых). Если ответ не разобрался,
+        categories пустой — тогда категории спросят отдельно через analyze_categories.
+        """
+        # Очевидные случаи решаем локально по словарю продуктов; категории потом посчитает analyze_categories
+        local = classifier.classify_ingredients(text)
+        if local is not None:
+            return {
+                "valid": local, "intent": "add_products" if local else "other",
+                "products": classifier.extract_products(text) if local else [], "dish_name": "", "categories": [],
+            }
+
+        key = f"{products_key(current_products)}|{products_key(text)}"
+        cached = YandexService.analysis_cache.get(key)
+        if cached is not None: return cached
+
+        prompt = f"""Ты опытный шеф-повар и модератор кулинарного бота.
+        Уже есть продукты: "{current_products}" (может быть пусто).
+        Контекст (последнее сообщение бота): {context[:500]}
+        Проанализируй новое сообщение пользователя и ВЕРНИ ТОЛЬКО JSON:
+        {{"valid": true если в сообщении есть съедобные продукты, иначе false,
+          "intent": "add_products" или "select_dish" или "other",
+          "products": ["продукты из нового сообщения, в именительном падеже"],
+          "dish_name": "название блюда, если пользователь выбирает блюдо, иначе пусто",
+          "categories": ["ключи категорий, которые РЕАЛЬНО приготовить из ВСЕХ продуктов (имея базовые соль/воду/масло)"]}}
+        Возможные категории: "soup", "main", "salad", "breakfast", "dessert", "drink", "snack".
+        """
+        result, res = await YandexService._ask_json(prompt, f"Сообщение: \"{text}\"", 0.1, "analyze_input", _as_analysis)
+        if result is not None:
+            YandexService.analysis_cache.set(key, result)
+            return result
+        # Не разобрали JSON: ведем себя как старый validate_ingredients
+        return {"valid": "true" in res.lower(), "intent": "unclear", "products": [], "dish_name": "", "categories": []}
 
     # --- ГЕНЕРАЦИЯ СПИСКА БЛЮД ---
     @staticmethod
+    @instrumented("generate_dishes_list")
     async def generate_dishes_list(products: str, category: str, style: str = "обычный") -> List[Dict[str, str]]:
         cat_names = {
             "soup": "Супы", "main": "Вторые блюда", "salad": "Салаты",
             "breakfast": "Завтраки", "dessert": "Десерты", "drink": "Напитки", "snack": "Закуски"
         }
         cat_ru = cat_names.get(category, "Блюда")
+        items = products_key(products).split(",")
+        key = f"{','.join(items)}|{category}|{style}"
+        cached = YandexService.dishes_cache.get(key)
+        if cached is not None: return cached
+        cached = YandexService.similar_dishes.get(f"{category}|{style}", items)
+        if cached is not None: return cached
 
         prompt = f"""Ты шеф-повар. Продукты: {products}.
         Задача: Придумай 5-6 разнообразных блюд в категории: "{cat_ru}". Стиль: {style}.
@@ -82,38 +535,40 @@ class YandexService:
             {{"name": "Название", "desc": "Краткое описание"}}
         ]
         """
-        res = await YandexService._send_gpt_request(prompt, "Предложи меню JSON", 0.5)
-        try:
-            clean_json = res.replace("```json", "").replace("```", "").strip()
-            data = json.loads(clean_json)
-            if isinstance(data, list): return data
-        except Exception: pass
-        return []
+        data, _ = await YandexService._ask_json(prompt, "Предложи меню JSON", 0.5, "generate_dishes_list", _as_dishes)
+        if data:
+            YandexService.dishes_cache.set(key, data)
+            YandexService.similar_dishes.set(f"{category}|{style}", items, data)
+        return data or []
 
     # --- ВСПОМОГАТЕЛЬНЫЕ ---
     @staticmethod
+    @instrumented("validate_ingredients")
     async def validate_ingredients(text: str) -> bool:
+        local = classifier.classify_ingredients(text)
+        if local is not None: return local
         prompt = """Твоя задача — модерация. Верни JSON: {"valid": true} если это съедобные продукты. Иначе false."""
-        res = await YandexService._send_gpt_request(prompt, f"Анализируй: \"{text}\"", 0.1)
-        return "true" in res.lower()
+        valid, res = await YandexService._ask_json(prompt, f"Анализируй: \"{text}\"", 0.1, "validate_ingredients", _as_validity)
+        return valid if valid is not None else "true" in res.lower()
 
     @staticmethod
+    @instrumented("determine_intent")
     async def determine_intent(user_message: str, dish_list_text: str) -> dict:
+        intent = classifier.classify_intent(user_message)
+        if intent == "thanks": return {"intent": intent}
+        if intent == "add_products":
+            return {"intent": intent, "products": ", ".join(classifier.extract_products(user_message)), "dish_name": ""}
         prompt = f"""Контекст: {dish_list_text}
         Сообщение: "{user_message}"
         Intent: "add_products" или "select_dish".
         JSON: {{"intent": "...", "products": "...", "dish_name": "..."}}"""
-        res = await YandexService._send_gpt_request(prompt, "Анализируй", 0.1)
-        try:
-            start, end = res.find('{'), res.rfind('}')
-            if start != -1: return json.loads(res[start:end+1])
-        except: pass
-        return {"intent": "unclear"}
+        data, _ = await YandexService._ask_json(prompt, "Анализируй", 0.1, "determine_intent", _as_intent)
+        return data or {"intent": "unclear"}
 
     # --- ОБНОВЛЕННАЯ ГЕНЕРАЦИЯ РЕЦЕПТА (С ТРИАДОЙ) ---
     @staticmethod
-    async def generate_recipe(dish_name: str, products: str) -> str:
-        prompt = f"""Напиши подробный рецепт: "{dish_name}".
+    def _recipe_prompt(dish_name: str, products: str) -> str:
+        return f"""Напиши подробный рецепт: "{dish_name}".
         Имеющиеся продукты: {products} (можно добавлять соль, перец, сахар, подсолнечное масло, лёд и воду по умолчанию).
         
         СТРУКТУРА ОТВЕТА:
@@ -126,24 +581,74 @@ class YandexService:
         Напиши короткий совет: чего не хватает для идеала в контексте кулинарной триады? Порекомендуй ТОЛЬКО ОДИН ингредиент!
         Пример: "Блюдо вышло жирным и мягким. Добавьте для баланса маринованный лук (кислота/хруст) или подайте с долькой лимона."
         """
-        
-        res = await YandexService._send_gpt_request(prompt, "Напиши рецепт с советом", 0.4)
-        if YandexService._is_refusal(res): return res
-        return res + "\n\n👨‍🍳 <b>Приятного аппетита!</b>"
 
     @staticmethod
-    async def generate_freestyle_recipe(dish_name: str) -> str:
+    def _freestyle_prompt(dish_name: str) -> str:
         # Тоже добавляем триаду для прямых запросов "Дай рецепт Х"
-        prompt = f"""Рецепт: "{dish_name}". 
+        return f"""Рецепт: "{dish_name}". 
         Стиль: Креативный, но понятный.
         
         В конце обязательно добавь блок:
         🎓 СОВЕТ ПО БАЛАНСУ ВКУСОВ (какой ОДИН ИНГРЕДИЕНТ добавить для контраста текстуры, вкуса или кислотности в рамках концепции кулинарной триады).
         """
-        res = await YandexService._send_gpt_request(prompt, "Напиши рецепт", 0.6)
-        if YandexService._is_refusal(res): return res
+
+    @staticmethod
+    def _finish_recipe(res: str) -> str:
+        # "" — ответа нет (ошибка или обрыв потока): подпись не добавляем, хэндлер покажет ошибку
+        if not res or YandexService._is_refusal(res): return res
         return res + "\n\n👨‍🍳 <b>Приятного аппетита!</b>"
-        
+
+    @staticmethod
+    def _recipe_key(dish_name: str, products: str) -> str:
+        return f"{dish_name.strip().lower()}|{products_key(products)}"
+
+    @staticmethod
+    @instrumented("generate_recipe")
+    async def generate_recipe(dish_name: str, products: str) -> str:
+        key = YandexService._recipe_key(dish_name, products)
+        cached = YandexService.recipes_cache.get(key)
+        if cached is not None: return cached
+
+        prompt = YandexService._recipe_prompt(dish_name, products)
+        res = await YandexService._send_gpt_request(prompt, "Напиши рецепт с советом", 0.4, priority=Priority.INTERACTIVE, route="generate_recipe")
+        recipe = YandexService._finish_recipe(res)
+        if res and recipe != res: YandexService.recipes_cache.set(key, recipe)
+        return recipe
+
+    @staticmethod
+    @instrumented("stream_recipe")
+    async def stream_recipe(dish_name: str, products: str) -> AsyncIterator[str]:
+        """Как generate_recipe, но отдает текст по мере генерации. Последнее значение — готовый рецепт."""
+        key = YandexService._recipe_key(dish_name, products)
+        cached = YandexService.recipes_cache.get(key)
+        if cached is not None:
+            yield cached
+            return
+
+        prompt = YandexService._recipe_prompt(dish_name, products)
+        res = ""
+        async for res in YandexService._stream_gpt_request(prompt, "Напиши рецепт с советом", 0.4, priority=Priority.INTERACTIVE, route="generate_recipe"):
+            yield res
+        recipe = YandexService._finish_recipe(res)
+        if res and recipe != res: YandexService.recipes_cache.set(key, recipe)
+        yield recipe
+
+    @staticmethod
+    @instrumented("generate_freestyle_recipe")
+    async def generate_freestyle_recipe(dish_name: str) -> str:
+        prompt = YandexService._freestyle_prompt(dish_name)
+        res = await YandexService._send_gpt_request(prompt, "Напиши рецепт", 0.6, priority=Priority.INTERACTIVE, route="freestyle_recipe")
+        return YandexService._finish_recipe(res)
+
+    @staticmethod
+    @instrumented("stream_freestyle_recipe")
+    async def stream_freestyle_recipe(dish_name: str) -> AsyncIterator[str]:
+        prompt = YandexService._freestyle_prompt(dish_name)
+        res = ""
+        async for res in YandexService._stream_gpt_request(prompt, "Напиши рецепт", 0.6, priority=Priority.INTERACTIVE, route="freestyle_recipe"):
+            yield res
+        yield YandexService._finish_recipe(res)
+
     @staticmethod
     def _is_refusal(text: str) -> bool:
         if "⛔" in text: return True